@@ -18,7 +18,7 @@ import igan_data
 from time import sleep
 import random
 
-from flask import Flask, render_template, request, make_response, Response
+from flask import Flask, render_template, request, make_response, Response, jsonify, abort
 
 from bokeh.models import PointDrawTool, ColumnDataSource, BoxSelectTool
 from bokeh.models.callbacks import CustomJS
@@ -28,6 +28,8 @@ from bokeh.colors import RGB
 
 import numpy as np
 import os
+import json
+import threading
 
 import io
 import base64
@@ -44,14 +46,20 @@ app = Flask(__name__)
 app.secret_key = 'some secret key'
 
 
+# init queue for training and imputation running in the background
+jobs = igan_server.JobQueue()
+# held while the data is updated, by the main window and by the sample stream of a job
+data_lock = threading.Lock()
+
 # init handlers
-load_handler = igan_server.LoadDataFormHandler("load_data_button", "input_file")
-generator_handler = igan_server.GenerateDataFormHandler("generate_data_button")
-imputation_handler = igan_server.ImputeDataFormHandler("impute_data_button")
+load_handler = igan_server.LoadDataFormHandler("load_data_button", "input_file", "append_data")
+generator_handler = igan_server.GenerateDataFormHandler("generate_data_button", jobs)
+imputation_handler = igan_server.ImputeDataFormHandler("impute_data_button", jobs)
 switch_orig_handler = igan_server.SwitchHandler("submit_button", "original", "change_to_orig", 0)
 switch_gen_handler = igan_server.SwitchHandler("submit_button", "synthesized", "change_to_gen", 0)
 switch_to_prev_handler = igan_server.SwitchHandler("rotate_button", "<<<", "prev", True)
 switch_to_next_handler = igan_server.SwitchHandler("rotate_button", ">>>", "next", True)
+materialise_handler = igan_server.SwitchHandler("materialise_button", "all samples", "gen_metrics", 0)
 json_handler = igan_server.JSONHandler()
 
 
@@ -68,11 +76,14 @@ manager = igan_server.HandlerManager([load_handler,
                                       switch_gen_handler,
                                       switch_to_prev_handler,
                                       switch_to_next_handler,
+                                      materialise_handler,
                                       json_handler])
 
 # init data dictionary
-data = {'orig_x': np.zeros((1, 1)), 'orig_y': np.zeros((1, 1)), 'orig_class': ['0'],
-        'gen_x': np.zeros((1, 1)), 'gen_y': np.zeros((1, 1)), 'gen_class': ['0'],
+data = {'orig': igan_server.SampleStore(np.zeros((1, 1)), [0], ['0']),
+        'gen': igan_server.SampleStore(np.zeros((1, 1)), [0], ['0']),
+        # novelty and diversity of the original samples, None until they are loaded
+        'orig_metrics': None,
         "ref_x": [], "ref_y": [],
         "start": 0, "end": 0,
         "current_orig": 0,
@@ -89,6 +100,8 @@ ui = {"original_select": "select-button",
       "end": "0",
       "current_orig": "0",
       "current_gen": "0",
+      # id of the last background job started from the UI
+      "job_id": "",
       "logs": []}
 
 WIDTH = 1200
@@ -96,117 +109,156 @@ HEIGHT = 380
 MARGIN = (0, 0, 0, 120)
 
 
+# merge the partial and final results of the background jobs into the data, call with data_lock held
+def merge_job_updates():
+    for updates in jobs.pop_updates():
+        apply_updates(updates)
+
+
+# apply the updates of the handlers or of a job to the data and the UI
+def apply_updates(updates):
+    # manage updates
+    if "orig_append" in updates:
+        if data['orig_metrics'] is None:
+            # nothing is loaded yet, so there is nothing to append to
+            updates["orig_store"] = updates["orig_append"]
+        else:
+            new = updates["orig_append"]
+            start, _ = data['orig'].append(new.sequences(), new.codes, new.labels)
+            # only the scores of the new samples (and their distances to the old ones) are computed
+            data['orig_metrics'].append(data['orig'].matrix(), start)
+            updates["change_to_orig"] = start
+    if "orig_store" in updates:
+        data['orig'] = updates["orig_store"]
+        data['orig_metrics'] = igan_data.DatasetMetrics(data['orig'].matrix())
+    if "orig_append" in updates or "orig_store" in updates:
+        ui["orig_nvlt"] = str(round(data['orig_metrics'].novelty()[3], 5))
+        ui["orig_div"] = str(round(data['orig_metrics'].diversity()[1], 5))
+    if "gen_stream" in updates:
+        data['gen'] = updates["gen_stream"]
+    if "gen_append" in updates:
+        new = updates["gen_append"]
+        data['gen'].append(new.sequences(), new.codes, new.labels)
+    if "gen_store" in updates:
+        data['gen'] = updates["gen_store"]
+    if "gen_lazy" in updates:
+        data['gen'] = updates["gen_lazy"]
+        # the statistics need all samples, they are computed once these are asked for with "gen_metrics"
+        ui["gen_nvlt"], ui["gen_div"], ui["gen_RMSE"] = "-", "-", "-"
+    if "gen_store" in updates or "gen_metrics" in updates:
+        ui["gen_nvlt"] = str(round(igan_data.data_novelty(data['gen'].matrix())[3], 5))
+        ui["gen_div"] = str(round(igan_data.data_diversity(data['gen'].matrix())[1], 5))
+        ui["gen_RMSE"] = str(round(igan_data.feat_RMSE(data["orig"].matrix(), data["gen"].matrix()), 5))
+        ui["gen_miscl"] = "50"
+    if "loss" in updates:
+        ui["gen_loss"] = str(round(updates["loss"], 5))
+    if "change_to_orig" in updates:
+        data["current_orig"] = updates["change_to_orig"]
+        data["display"] = "orig"
+        ui["current_orig"] = str(updates["change_to_orig"])
+        ui["current_orig_class"] = str(data["orig"].label(data["current_orig"]))
+        ui["original_select"] = "select-button"
+        ui["synthesized_select"] = "unselect-button"
+    if "change_to_gen" in updates:
+        data["current_gen"] = updates["change_to_gen"]
+        data["display"] = "gen"
+        ui["current_gen"] = str(updates["change_to_gen"])
+        ui["current_gen_class"] = str(data["gen"].label(data["current_gen"]))
+        ui["original_select"] = "unselect-button"
+        ui["synthesized_select"] = "select-button"
+    if "updated_sample" in updates:
+        # a background imputation only updates the sample it was started on
+        if updates.get("sample_store", data["gen"]) is data["gen"]:
+            data["gen"].set_sample(updates.get("sample_index", data["current_gen"]), updates["updated_sample"])
+    if "next" in updates:
+        if data["display"] == "orig":
+            if not data["current_orig"] + 1 < len(data["orig"]):
+                data["current_orig"] = 0
+            else:
+                data["current_orig"] += 1
+            ui["current_orig"] = str(data["current_orig"])
+            ui["current_orig_class"] = str(data["orig"].label(data["current_orig"]))
+        else:
+            if not data["current_gen"] + 1 < len(data["gen"]):
+                data["current_gen"] = 0
+            else:
+                data["current_gen"] += 1
+            ui["current_gen"] = str(data["current_gen"])
+            ui["current_gen_class"] = str(data["gen"].label(data["current_gen"]))
+    if "prev" in updates:
+        if data["display"] == "orig":
+            if data["current_orig"] - 1 < 0:
+                data["current_orig"] = len(data["orig"]) - 1
+            else:
+                data["current_orig"] -= 1
+            ui["current_orig"] = str(data["current_orig"])
+            ui["current_orig_class"] = str(data["orig"].label(data["current_orig"]))
+        else:
+            if data["current_gen"] - 1 < 0:
+                data["current_gen"] = len(data["gen"]) - 1
+            else:
+                data["current_gen"] -= 1
+            ui["current_gen"] = str(data["current_gen"])
+            ui["current_gen_class"] = str(data["gen"].label(data["current_gen"]))
+
+    if "ref_points_x" in updates:
+        data["ref_x"] = updates["ref_points_x"]
+        ui["ref_x"] = [str(el) for el in data["ref_x"]]
+    if "ref_points_y" in updates:
+        data["ref_y"] = updates["ref_points_y"]
+        ui["ref_y"] = [str(el) for el in data["ref_y"]]
+    if "start" in updates:
+        data["start"] = updates["start"]
+        ui["start"] = str(updates["start"])
+    if "end" in updates:
+        data["end"] = updates["end"]
+        ui["end"] = str(updates["end"])
+
+
 @app.route('/', methods=['GET', 'POST', 'DELETE'])
 def main_window():
 
-    if request.method == 'POST':
-        # prepare data pack for messages
-        data_pack = {'data_dict': data}
-        # get updates from the manager
-        updates = manager.handle(request, data_pack)
-        # manage updates
-        if "orig_data_vals" in updates:
-            data['orig_y'] = updates["orig_data_vals"]
-            ui["orig_nvlt"] = str(round(igan_data.data_novelty(data['orig_y'])[3], 5))
-            ui["orig_div"] = str(round(igan_data.data_diversity(data['orig_y'])[1], 5))
-        if "orig_data_timestamps" in updates:
-            data['orig_x'] = updates["orig_data_timestamps"]
-        if "orig_data_classes" in updates:
-            data['orig_class'] = updates["orig_data_classes"]
-        if "gen_data_vals" in updates:
-            data['gen_y'] = updates["gen_data_vals"]
-            ui["gen_nvlt"] = str(round(igan_data.data_novelty(data['gen_y'])[3], 5))
-            ui["gen_div"] = str(round(igan_data.data_diversity(data['gen_y'])[1], 5))
-            ui["gen_RMSE"] = str(round(igan_data.feat_RMSE(data["orig_y"], data["gen_y"]), 5))
-            ui["gen_miscl"] = "50"
-        if "loss" in updates:
-            ui["gen_loss"] = str(round(updates["loss"], 5))
-        if "gen_data_timestamps" in updates:
-            data['gen_x'] = updates["gen_data_timestamps"]
-        if "gen_data_classes" in updates:
-            data['gen_class'] = updates["gen_data_classes"]
-        if "change_to_orig" in updates:
-            data["current_orig"] = updates["change_to_orig"]
-            data["display"] = "orig"
-            ui["current_orig"] = str(updates["change_to_orig"])
-            ui["current_orig_class"] = str(data["orig_class"][data["current_orig"]])
-            ui["original_select"] = "select-button"
-            ui["synthesized_select"] = "unselect-button"
-        if "change_to_gen" in updates:
-            data["current_gen"] = updates["change_to_gen"]
-            data["display"] = "gen"
-            ui["current_gen"] = str(updates["change_to_gen"])
-            ui["current_gen_class"] = str(data["gen_class"][data["current_gen"]])
-            ui["original_select"] = "unselect-button"
-            ui["synthesized_select"] = "select-button"
-        if "updated_sample" in updates:
-            data["gen_y"][data["current_gen"], :] = updates["updated_sample"]
-        if "next" in updates:
-            if data["display"] == "orig":
-                if not data["current_orig"] + 1 < data["orig_y"].shape[0]:
-                    data["current_orig"] = 0
-                else:
-                    data["current_orig"] += 1
-                ui["current_orig"] = str(data["current_orig"])
-                ui["current_orig_class"] = str(data["orig_class"][data["current_orig"]])
-            else:
-                if not data["current_gen"] + 1 < data["gen_y"].shape[0]:
-                    data["current_gen"] = 0
-                else:
-                    data["current_gen"] += 1
-                ui["current_gen"] = str(data["current_gen"])
-                ui["current_gen_class"] = str(data["gen_class"][data["current_gen"]])
-        if "prev" in updates:
-            if data["display"] == "orig":
-                if data["current_orig"] - 1 < 0:
-                    data["current_orig"] = data["orig_y"].shape[0] - 1
-                else:
-                    data["current_orig"] -= 1
-                ui["current_orig"] = str(data["current_orig"])
-                ui["current_orig_class"] = str(data["orig_class"][data["current_orig"]])
-            else:
-                if data["current_gen"] - 1 < 0:
-                    data["current_gen"] = data["gen_y"].shape[0] - 1
-                else:
-                    data["current_gen"] -= 1
-                ui["current_gen"] = str(data["current_gen"])
-                ui["current_gen_class"] = str(data["gen_class"][data["current_gen"]])
+    # whether this request started a background job
+    new_job = False
+    with data_lock:
+        # merge the results of the background jobs reported since the last request
+        merge_job_updates()
 
-        if "ref_points_x" in updates:
-            data["ref_x"] = updates["ref_points_x"]
-            ui["ref_x"] = [str(el) for el in data["ref_x"]]
-        if "ref_points_y" in updates:
-            data["ref_y"] = updates["ref_points_y"]
-            ui["ref_y"] = [str(el) for el in data["ref_y"]]
-        if "start" in updates:
-            data["start"] = updates["start"]
-            ui["start"] = str(updates["start"])
-        if "end" in updates:
-            data["end"] = updates["end"]
-            ui["end"] = str(updates["end"])
+        if request.method == 'POST':
+            # prepare data pack for messages
+            data_pack = {'data_dict': data}
+            # get updates from the manager
+            updates = manager.handle(request, data_pack)
+            apply_updates(updates)
+            if "job" in updates:
+                ui["job_id"] = updates["job"]
+                new_job = True
 
-    print("start", data["start"])
-    print("end", data["end"])
+        print("start", data["start"])
+        print("end", data["end"])
 
-    plot = create_chart()
-    script, div = components(plot)
+        plot = create_chart()
+        script, div = components(plot)
 
 
 
     return render_template("home.html",
                            the_div=div,
                            the_script=script,
-                           UI=ui)
+                           UI=ui,
+                           new_job=new_job)
 
 
 @app.route('/generated_data.csv', methods=['GET', 'POST', 'DELETE'])
 def download_window():
     # if some data was generated
-    if len(data["gen_y"]) != 0:
-        # prepare data to save
+    if len(data["gen"]) != 0:
+        # prepare data to save, generating the samples of a lazy store that are still missing
+        with data_lock:
+            gen = data["gen"].matrix()
         csv = ''
-        for i in range(len(data["gen_y"])):
-            csv += str(data["gen_y"][i])
+        for i in range(len(gen)):
+            csv += str(gen[i])
         # prepare response to save
         response = make_response(csv)
         cd = 'attachment; filename=generated_data.csv'
@@ -220,6 +272,75 @@ def download_window():
         return render_template("download.html")
 
 
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    """returns the status and progress of a background job"""
+    job = jobs.get(job_id)
+    if job is None:
+        abort(404)
+    return jsonify(job.info())
+
+
+@app.route('/jobs/<job_id>/cancel', methods=['POST'])
+def job_cancel(job_id):
+    """cancels a background job, it stops at its next progress report"""
+    job = jobs.cancel(job_id)
+    if job is None:
+        abort(404)
+    return jsonify(job.info())
+
+
+@app.route('/jobs/<job_id>/result')
+def job_result(job_id):
+    """returns the scalar results of a finished job, e.g. the loss"""
+    job = jobs.get(job_id)
+    if job is None:
+        abort(404)
+    if job.status != 'done':
+        return jsonify(job.info()), 409
+    # the results themselves are merged into the data store by the main window
+    return jsonify(dict(job.info(), result=job.scalar_result()))
+
+
+@app.route('/jobs/<job_id>/samples')
+def job_samples(job_id):
+    """streams an event with every sample a generation job has finished (its index, class and values), the
+    samples are appended to the generated data as they arrive"""
+    job = jobs.get(job_id)
+    if job is None:
+        abort(404)
+    return Response(job_sample_events(job), mimetype="text/event-stream")
+
+
+# yields a server-sent event for every sample the job generates, until it finishes
+def job_sample_events(job):
+    sent = 0
+    while True:
+        finished = job.finished
+        # read before merging: the samples a job reports are published before its progress
+        generated = job.progress.get("generated", 0)
+        events = []
+        with data_lock:
+            merge_job_updates()
+            num_gen = len(data["gen"])
+            # sample i of a streaming job is sample i of the generated data
+            for i in range(sent, min(generated, num_gen)):
+                events.append({"index": i, "class": str(data["gen"].label(i)),
+                               "x": np.asarray(data["gen"].timestamps(i)).tolist(),
+                               "y": np.asarray(data["gen"].sample(i)).tolist(),
+                               "generated": generated, "num_gen": num_gen})
+            # the chart follows the new samples while it shows the generated data
+            if events and data["display"] == "gen":
+                apply_updates({"change_to_gen": events[-1]["index"]})
+        sent += len(events)
+        for event in events:
+            yield "data: " + json.dumps(event) + "\n\n"
+        if finished:
+            yield "event: done\ndata: " + json.dumps(job.info()) + "\n\n"
+            return
+        sleep(0.5)
+
+
 @app.route("/log_stream", methods=["GET", "POST"])
 def stream():
     """returns logging information"""
@@ -267,10 +388,10 @@ def flask_logger(cell_content):
 
 def create_chart():
     # divide dict into parts
-    orig_data = {"orig_x": data["orig_x"][data["current_orig"]],
-                 "orig_y": data["orig_y"][data["current_orig"]]}
-    gen_data = {"gen_x": data["gen_x"][data["current_gen"]],
-                "gen_y": data["gen_y"][data["current_gen"]]}
+    orig_data = {"orig_x": data["orig"].timestamps(data["current_orig"]),
+                 "orig_y": data["orig"].sample(data["current_orig"])}
+    gen_data = {"gen_x": data["gen"].timestamps(data["current_gen"]),
+                "gen_y": data["gen"].sample(data["current_gen"])}
 
     # init necessary tools
     tools = ["pan,wheel_zoom,box_zoom,reset"]
@@ -281,7 +402,8 @@ def create_chart():
         source = ColumnDataSource(data=orig_data)
     else:
         # create a corresponding data source objects
-        source = ColumnDataSource(data=gen_data)
+        # named so that the page can draw the samples of a generation into it as they arrive
+        source = ColumnDataSource(data=gen_data, name="gen_source")
         added_points_source = ColumnDataSource(data={'gen_x': [], 'gen_y': []})
 
     # create a plot
@@ -373,8 +495,8 @@ def orig_clsdist_plot_png():
     # axis.set_facecolor(light_purple)
     fig.patch.set_facecolor(light_purple)
     # if there is some data, add it to the plot
-    if len(data["orig_y"]) >= 2:
-        x,y = igan_data.class_dist(data["orig_class"])
+    if len(data["orig"]) >= 2:
+        x,y = igan_data.class_dist(data["orig"].classes())
         axis.pie(x, labels=y, autopct='%1.1f%%', shadow=True, startangle=90)
     output = io.BytesIO()
     FigureCanvas(fig).print_png(output)
@@ -389,8 +511,8 @@ def orig_dsdiv_plot_png():
     # axis.set_facecolor(light_purple)
     fig.patch.set_facecolor(light_purple)
     # if there is some data, add it to the plot
-    if len(data["orig_y"]) >= 2:
-        t, _ = igan_data.data_diversity(data["orig_y"])
+    if len(data["orig"]) >= 2:
+        t, _ = data['orig_metrics'].diversity()
         axis.hist(t, color='red', bins=40, label='Diversity')
     output = io.BytesIO()
     FigureCanvas(fig).print_png(output)
@@ -405,8 +527,8 @@ def orig_dsdist_plot_png():
     # axis.set_facecolor(light_purple)
     fig.patch.set_facecolor(light_purple)
     # if there is some data, add it to the plot
-    if len(data["orig_y"]) >= 2:
-        m = igan_data.data_dist(data["orig_y"])
+    if len(data["orig"]) >= 2:
+        m = igan_data.data_dist(data["orig"].matrix())
         axis.hist(m, color='green', bins=20)
     output = io.BytesIO()
     FigureCanvas(fig).print_png(output)
@@ -421,8 +543,8 @@ def orig_dsnvlt_plot_png():
     # axis.set_facecolor(light_purple)
     fig.patch.set_facecolor(light_purple)
     # if there is some data, add it to the plot
-    if len(data["orig_y"]) >= 2:
-        _, flattened_f, _, _ = igan_data.data_novelty(data["orig_y"])
+    if len(data["orig"]) >= 2:
+        _, flattened_f, _, _ = data['orig_metrics'].novelty()
         axis.hist(flattened_f, color='blue', bins=20,label='Novelty')
     output = io.BytesIO()
     FigureCanvas(fig).print_png(output)
@@ -437,8 +559,8 @@ def gen_clsdist_plot_png():
     # axis.set_facecolor(light_purple)
     fig.patch.set_facecolor(light_purple)
     # if there is some data, add it to the plot
-    if len(data["gen_y"]) >= 2:
-        x,y = igan_data.class_dist(data["gen_class"])
+    if len(data["gen"]) >= 2:
+        x,y = igan_data.class_dist(data["gen"].classes())
         axis.pie(x, labels=y, autopct='%1.1f%%', shadow=True, startangle=90)
     output = io.BytesIO()
     FigureCanvas(fig).print_png(output)
@@ -452,9 +574,9 @@ def gen_dsdiv_plot_png():
     axis = fig.add_subplot(1, 1, 1)
     # axis.set_facecolor(light_purple)
     fig.patch.set_facecolor(light_purple)
-    # if there is some data, add it to the plot
-    if len(data["gen_y"]) >= 2:
-        t, _ = igan_data.data_diversity(data["gen_y"])
+    # if there is some data, add it to the plot (lazily generated data once all of it is generated)
+    if len(data["gen"]) >= 2 and data["gen"].materialised:
+        t, _ = igan_data.data_diversity(data["gen"].matrix())
         axis.hist(t, color='red', bins=40, label='Diversity')
     output = io.BytesIO()
     FigureCanvas(fig).print_png(output)
@@ -468,9 +590,9 @@ def gen_dsdist_plot_png():
     axis = fig.add_subplot(1, 1, 1)
     # axis.set_facecolor(light_purple)
     fig.patch.set_facecolor(light_purple)
-    # if there is some data, add it to the plot
-    if len(data["gen_y"]) >= 2:
-        m = igan_data.data_dist(data["gen_y"])
+    # if there is some data, add it to the plot (lazily generated data once all of it is generated)
+    if len(data["gen"]) >= 2 and data["gen"].materialised:
+        m = igan_data.data_dist(data["gen"].matrix())
         axis.hist(m, color='green', bins=20)
     output = io.BytesIO()
     FigureCanvas(fig).print_png(output)
@@ -484,9 +606,9 @@ def gen_dsnvlt_plot_png():
     axis = fig.add_subplot(1, 1, 1)
     # axis.set_facecolor(light_purple)
     fig.patch.set_facecolor(light_purple)
-    # if there is some data, add it to the plot
-    if len(data["gen_y"]) >= 2:
-        _, flattened_f, _, _ = igan_data.data_novelty(data["gen_y"])
+    # if there is some data, add it to the plot (lazily generated data once all of it is generated)
+    if len(data["gen"]) >= 2 and data["gen"].materialised:
+        _, flattened_f, _, _ = igan_data.data_novelty(data["gen"].matrix())
         axis.hist(flattened_f, color='blue', bins=20,label='Novelty')
     output = io.BytesIO()
     FigureCanvas(fig).print_png(output)
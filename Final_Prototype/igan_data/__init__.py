@@ -1,6 +1,29 @@
+import importlib
 from .data_utils import *
-from .gen_data import *
-from .model import *
-from .model_utils import *
-from .impute_data import *
-from .stat_utils import *
\ No newline at end of file
+from .model_registry import *
+from .numpy_sampler import *
+
+# modules that import TensorFlow (or scikit-bio), imported on first use of one of their names
+# so that e.g. igan_data.numpy_sampler and igan_data.data_utils load without them
+_LAZY_MODULES = ('gen_data', 'model', 'model_utils', 'impute_data', 'stat_utils')
+_EAGER_NAMES = frozenset(globals())
+
+
+# imports the lazy modules and binds their names as `from .module import *` would
+def _import_lazy_modules():
+    namespace = globals()
+    for module_name in _LAZY_MODULES:
+        module = importlib.import_module('.' + module_name, __name__)
+        namespace[module_name] = module
+        for name, value in vars(module).items():
+            if not name.startswith('_') and name not in _EAGER_NAMES:
+                namespace[name] = value
+
+
+def __getattr__(name):
+    if name.startswith('__'):
+        raise AttributeError(name)
+    _import_lazy_modules()
+    if name in globals():
+        return globals()[name]
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
@@ -14,70 +14,406 @@ The above copyright notice and this permission notice shall be included in all c
 THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 """
 
+import hashlib
+import io
+import multiprocessing
 import numpy as np
 import os
+import posixpath
+import queue
+import shutil
 import sys
+import threading
+import time
 from scipy.io import loadmat
 from zipfile import ZipFile
 
-if os.name == 'posix':
-    fchar = '/'
-else:
-    fchar = '\\'
+
+class RaggedArray(object):
+    """ Sequences of different lengths stored back to back in one flat buffer.
+    Sequence i is values[offsets[i]:offsets[i+1]]. Indexing with an integer
+    returns a view of one sequence, indexing with a slice returns a
+    RaggedArray viewing a range of sequences, and indexing with an array of
+    indices copies the selected sequences into a new RaggedArray.
+    """
+    def __init__(self, values, offsets):
+        self.values = values
+        self.offsets = offsets
+
+    @classmethod
+    def from_sequences(cls, sequences, dtype=np.float32):
+        lengths = np.array([len(seq) for seq in sequences], dtype=np.int64)
+        offsets = np.zeros(len(sequences) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        values = np.empty(offsets[-1], dtype=dtype)
+        for i, seq in enumerate(sequences):
+            values[offsets[i]:offsets[i+1]] = seq
+        return cls(values, offsets)
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    @property
+    def dtype(self):
+        return self.values.dtype
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step == 1:
+                offsets = self.offsets[start:max(start, stop)+1]
+                return RaggedArray(self.values[offsets[0]:offsets[-1]], offsets - offsets[0])
+            index = np.arange(start, stop, step)
+        if isinstance(index, (int, np.integer)):
+            if index < 0:
+                index += len(self)
+            return self.values[self.offsets[index]:self.offsets[index+1]]
+        return RaggedArray.from_sequences([self[int(i)] for i in np.asarray(index).ravel()], self.dtype)
+
+    def is_uniform(self):
+        return len(self) == 0 or np.all(self.lengths == self.offsets[1])
+
+    def to_matrix(self):
+        """ Returns the sequences as an (n, len) matrix view; they must all have the same length. """
+        if not self.is_uniform():
+            raise ValueError('sequences have different lengths')
+        return self.values[self.offsets[0]:self.offsets[-1]].reshape((len(self), -1))
+
+    def padded(self, length=None, fill=0.0):
+        """ Returns an (n, length) matrix with every sequence padded (or cut) to length. """
+        length = int(self.lengths.max()) if length is None else length
+        out = np.full((len(self), length), fill, dtype=self.dtype)
+        for i in range(len(self)):
+            seq = self[i][:length]
+            out[i, :len(seq)] = seq
+        return out
+
+
+def sequence_lengths(data):
+    """ Returns the length of every sequence of a matrix or RaggedArray. """
+    if isinstance(data, RaggedArray):
+        return data.lengths
+    return np.full(data.shape[0], data.shape[1], dtype=np.int64)
+
+
+def _is_data_member(info, data_type):
+    """ Returns True for zip members holding a data file of the given type.
+    Folders and the metadata that macOS adds to archives are skipped.
+    """
+    name = info.filename
+    return (not info.is_dir() and name.lower().endswith(data_type)
+            and not name.startswith('__MACOSX/')
+            and not posixpath.basename(name).startswith('.'))
+
+
+def _list_data_members(zipObj, data_type='.mat'):
+    """ Returns the sorted names of all data files inside an open zip file. """
+    return sorted(info.filename for info in zipObj.infolist() if _is_data_member(info, data_type))
+
+
+def _member_class(name):
+    """ Returns the class of a zip member, i.e. the name of its parent folder. """
+    return posixpath.basename(posixpath.dirname(name))
+
+
+# the readers return the decoded member as a float32 matrix; a record is all
+# of its values in row-major order
+
+def _read_mat_member(zipObj, name):
+    """ Decodes the 'val' record of a .mat member without extracting it. """
+    return loadmat(io.BytesIO(zipObj.read(name)))['val'].astype(np.float32, copy=False)
+
+
+def _csv_header_lines(raw):
+    """ Returns 1 if the first line of a csv file is a header, 0 otherwise. """
+    try:
+        [float(field) for field in raw.split(b'\n', 1)[0].split(b',')]
+    except ValueError:
+        return 1
+    return 0
+
+
+def _read_csv_member(zipObj, name):
+    """ Parses a .csv member without extracting it.
+    np.loadtxt parses all columns in C straight into float32; files with
+    missing values fall back to np.genfromtxt, which turns them into NaN.
+    """
+    raw = zipObj.read(name)
+    header = _csv_header_lines(raw)
+    try:
+        return np.loadtxt(io.BytesIO(raw), delimiter=',', dtype=np.float32, skiprows=header, ndmin=2)
+    except ValueError:
+        return np.genfromtxt(io.BytesIO(raw), delimiter=',', dtype=np.float32, skip_header=header, ndmin=2)
+
+
+_READERS = {'.mat': _read_mat_member, '.csv': _read_csv_member}
+
+# archives with fewer members are decoded in the calling process, since
+# starting the workers would take longer than decoding them
+PARALLEL_MIN_FILES = 256
+
+# decoded datasets kept by load_dataset(cache_dir=...), in bytes
+CACHE_MAX_BYTES = 2 * 1024 ** 3
+# bump when the decoded format changes so stale cache entries are not reused
+CACHE_VERSION = 3
+CACHE_ARRAYS = ('values', 'offsets', 'class_codes', 'class_labels', 'norm_params')
+
+
+def _normalize(exp_data):
+    """ Normalizes a record in place to zero mean and unit variance.
+    Returns the (mean, std) it was normalized with.
+    """
+    mean, std = np.mean(exp_data), np.std(exp_data)
+    exp_data -= mean
+    exp_data /= std # normalize for numerical stability
+    return mean, std
+
+
+def _decode_rows(zipObj, data_type, names, values, norm_params, start):
+    """ Decodes and normalizes members into rows start, start+1, ... of values.
+    Records whose length differs from the width of values are not stored
+    there but returned, normalized, in a dict keyed by their row.
+    Returns (number of file rows that were parsed, dict of odd-length records).
+    """
+    read = _READERS[data_type]
+    seq_len = values.shape[1]
+    rows = 0
+    odd_records = {}
+    for i, name in enumerate(names, start):
+        exp_data = read(zipObj, name)
+        if exp_data.size == seq_len:
+            values[i] = exp_data.ravel()
+            norm_params[i] = _normalize(values[i])
+        else:
+            odd_records[i] = exp_data.ravel()
+            norm_params[i] = _normalize(odd_records[i])
+        rows += exp_data.shape[0]
+    return rows, odd_records
+
+
+# output arrays shared with the parent process, set up by _init_worker
+_worker_values = None
+_worker_norm_params = None
+
+
+def _init_worker(raw_values, raw_norm_params, shape):
+    global _worker_values, _worker_norm_params
+    _worker_values = np.frombuffer(raw_values, dtype=np.float32).reshape(shape)
+    _worker_norm_params = np.frombuffer(raw_norm_params, dtype=np.float32).reshape((shape[0], 2))
+
+
+def _decode_shard(task):
+    """ Worker side of _decode_members: decodes one shard of the archive. """
+    data_file, data_type, start, names = task
+    with ZipFile(data_file, 'r') as zipObj:
+        return _decode_rows(zipObj, data_type, names, _worker_values, _worker_norm_params, start)
+
+
+def _ragged_values(values, odd_records):
+    """ Merges the records decoded into the rows of values with the ones of other lengths. """
+    lengths = np.full(values.shape[0], values.shape[1], dtype=np.int64)
+    for i, exp_data in odd_records.items():
+        lengths[i] = exp_data.size
+    offsets = np.zeros(values.shape[0] + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    flat = np.empty(offsets[-1], dtype=np.float32)
+    for i in range(values.shape[0]):
+        flat[offsets[i]:offsets[i+1]] = odd_records[i] if i in odd_records else values[i]
+    return RaggedArray(flat, offsets)
+
+
+def _decode_members(zipObj, data_type='.mat', data_file=None, num_workers=1):
+    """ Decodes all members of the given type of an open zip file into one matrix.
+    The zip index is read first to count the records of every class, so the
+    float32 value matrix and the integer class codes are allocated once and
+    filled in place instead of being concatenated class by class. Its width is
+    the length of a record with the most common member size; if some records
+    have another length the result is a RaggedArray instead of a matrix.
+    With num_workers > 1 (None means one per CPU) and data_file pointing to the
+    archive on disk, shards of members are decoded by a pool of processes that
+    write straight into the shared value matrix.
+    The decoding throughput is printed in file rows (records for .mat) per second.
+    Returns (values, class_codes, class_labels, norm_params), see load_dataset.
+    """
+    members = sorted(_list_data_members(zipObj, data_type), key=lambda name: (_member_class(name), name))
+    class_labels, class_codes = np.unique([_member_class(name) for name in members], return_inverse=True)
+    class_codes = class_codes.astype(np.int32)
+    # records of the same length almost always have the same file size
+    sizes = np.array([zipObj.getinfo(name).file_size for name in members])
+    common_sizes, counts = np.unique(sizes, return_counts=True)
+    probe = members[int(np.argmax(sizes == common_sizes[np.argmax(counts)]))]
+    shape = (len(members), _READERS[data_type](zipObj, probe).size)
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+    start_time = time.time()
+    if num_workers > 1 and len(members) >= PARALLEL_MIN_FILES and isinstance(data_file, (str, os.PathLike)):
+        # never fork: the caller may be a threaded server with tensorflow loaded. The workers are forked
+        # from a fork server that has only imported this module (and the numpy-only package __init__),
+        # or spawned where there is no fork server
+        if 'forkserver' in multiprocessing.get_all_start_methods():
+            ctx = multiprocessing.get_context('forkserver')
+            ctx.set_forkserver_preload([__name__])
+        else:
+            ctx = multiprocessing.get_context('spawn')
+        raw_values = ctx.RawArray('f', shape[0] * shape[1])
+        raw_norm_params = ctx.RawArray('f', shape[0] * 2)
+        values = np.frombuffer(raw_values, dtype=np.float32).reshape(shape)
+        norm_params = np.frombuffer(raw_norm_params, dtype=np.float32).reshape((shape[0], 2))
+        # a few shards per worker keep all of them busy when some files are slower to decode
+        shard_size = -(-len(members) // (4 * num_workers))
+        tasks = [(data_file, data_type, i, members[i:i + shard_size]) for i in range(0, len(members), shard_size)]
+        rows, odd_records = 0, {}
+        with ctx.Pool(num_workers, initializer=_init_worker, initargs=(raw_values, raw_norm_params, shape)) as pool:
+            for shard_rows, shard_odd_records in pool.imap_unordered(_decode_shard, tasks):
+                rows += shard_rows
+                odd_records.update(shard_odd_records)
+    else:
+        values = np.empty(shape, dtype=np.float32)
+        norm_params = np.empty((shape[0], 2), dtype=np.float32)
+        rows, odd_records = _decode_rows(zipObj, data_type, members, values, norm_params, 0)
+    if odd_records:
+        values = _ragged_values(values, odd_records)
+    elapsed = max(time.time() - start_time, 1e-9)
+    print('Decoded %d rows from %d %s files in %.2fs (%.0f rows/s)' % (rows, len(members), data_type, elapsed, rows / elapsed))
+    return values, class_codes, class_labels, norm_params
+
+
+def _archive_key(data_file, data_type):
+    """ Returns the cache key of an archive: a hash of its content and the decoding format. """
+    digest = hashlib.sha256(('%s:%d:' % (data_type, CACHE_VERSION)).encode())
+    f = open(data_file, 'rb') if isinstance(data_file, (str, os.PathLike)) else data_file
+    try:
+        pos = f.tell()
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+        f.seek(pos)
+    finally:
+        if f is not data_file:
+            f.close()
+    return digest.hexdigest()
+
+
+def _dir_size(path):
+    return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+
+
+def _evict_lru(cache_dir, max_bytes, keep=None):
+    """ Deletes the least recently used entries of a cache directory until it
+    holds at most max_bytes. Every entry is a sub-directory whose modification
+    time is refreshed when it is used; the entry named keep is never deleted.
+    """
+    entries = [entry for entry in os.scandir(cache_dir) if entry.is_dir() and '.tmp' not in entry.name]
+    entries.sort(key=lambda entry: entry.stat().st_mtime)
+    sizes = [_dir_size(entry.path) for entry in entries]
+    total = sum(sizes)
+    for entry, size in zip(entries, sizes):
+        if total <= max_bytes:
+            break
+        if entry.name != keep:
+            shutil.rmtree(entry.path, ignore_errors=True)
+            total -= size
+
+
+def _load_cached(entry_dir):
+    """ Memory-maps a decoded dataset from the cache, or returns None on a miss. """
+    try:
+        flat, offsets, class_codes, class_labels, norm_params = (
+            np.load(os.path.join(entry_dir, name + '.npy'), mmap_mode='r') for name in CACHE_ARRAYS)
+    except (OSError, ValueError):
+        return None
+    os.utime(entry_dir) # mark as recently used
+    values = RaggedArray(flat, offsets)
+    if values.is_uniform():
+        values = values.to_matrix()
+    return values, class_codes, class_labels, norm_params
+
+
+def _store_cached(entry_dir, arrays):
+    """ Saves a decoded dataset to the cache, atomically with respect to other requests. """
+    values, class_codes, class_labels, norm_params = arrays
+    if not isinstance(values, RaggedArray):
+        values = RaggedArray(values.ravel(), np.arange(values.shape[0] + 1, dtype=np.int64) * values.shape[1])
+    tmp_dir = '%s.tmp%d' % (entry_dir, os.getpid())
+    os.makedirs(tmp_dir, exist_ok=True)
+    for name, array in zip(CACHE_ARRAYS, (values.values, values.offsets, class_codes, class_labels, norm_params)):
+        np.save(os.path.join(tmp_dir, name + '.npy'), array)
+    try:
+        os.replace(tmp_dir, entry_dir)
+    except OSError: # stored concurrently by another request
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def load_dataset(data_file, data_type='.mat', num_workers=1, cache_dir=None, cache_max_bytes=CACHE_MAX_BYTES):
+    """ Decodes a zipped dataset.
+    Returns (values, class_codes, class_labels, norm_params) where
+    values is a float32 matrix of shape (n_exp, len) with normalized records
+    (a RaggedArray if the records do not all have the same length),
+    class_codes holds the int32 class of every record, class_labels[class_codes]
+    gives the name of the class (the folder a record is stored in), and
+    norm_params holds the (mean, std) every record was normalized with.
+    data_file can be a path or a file-like object; members are decoded straight
+    from the archive and nothing is extracted to disk.
+    num_workers > 1 decodes large archives in parallel (None: one worker per CPU).
+    With cache_dir set, decoded datasets are kept there as .npy files keyed by
+    the content of the archive, so loading the same archive again only
+    memory-maps them (read-only). The cache is trimmed to cache_max_bytes by
+    deleting the least recently used datasets.
+    """
+    if cache_dir is not None:
+        key = _archive_key(data_file, data_type)
+        entry_dir = os.path.join(cache_dir, key)
+        arrays = _load_cached(entry_dir)
+        if arrays is not None:
+            print('Loaded dataset from cache.')
+            return arrays
+    with ZipFile(data_file, 'r') as zipObj:
+        arrays = _decode_members(zipObj, data_type, data_file, num_workers)
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        _store_cached(entry_dir, arrays)
+        _evict_lru(cache_dir, cache_max_bytes, keep=key)
+    return arrays
+
 
 #dataset is a zip file
-def load_training_data(data_file, data_type='.mat'):
+def load_training_data(data_file, data_type='.mat', num_workers=1, cache_dir=None):
     """ Returns a matrix of training data.
     shape of result = (n_exp, len)
+    (a RaggedArray if the records have different lengths).
+    For .mat data the class of every record and the number of classes are
+    returned as well. See load_dataset for the arguments.
     """
     print('Loading dataset...')
+    data, class_codes, classList, _ = load_dataset(data_file, data_type, num_workers, cache_dir)
+    print('Loaded dataset.')
     if(data_type=='.csv'):
-        t = [i for i, letter in enumerate(data_file) if letter == '/']
-        with ZipFile(data_file, 'r') as zipObj:
-            zipObj.extractall(data_file[:t[-1]+1])
-        data_dir = data_file[:-4]
-        data_files = [f for f in os.listdir(data_dir) if f.endswith('.csv')]
-        data_list = []
-        for fname in data_files:
-            exp_data =  np.genfromtxt(os.path.join(data_dir, fname), delimiter=",")
-            exp_data = (exp_data - np.mean(exp_data)) / np.std(exp_data) # normalize for numerical stability
-            data_list.append(exp_data)
-        data = np.stack(data_list)
-        print('Loaded dataset.')
         return data
     else:
-        with ZipFile(data_file, 'r') as zipObj:
-            zipObj.extractall(os.path.dirname(data_file))
-        data_dir = os.path.join(os.path.dirname(data_file), zipObj.namelist()[0][:-1])
-        classList = [f for f in os.listdir(data_dir) if any(char.isdigit() for char in f)]
-        f_temp = [f for f in os.listdir(data_dir+fchar+classList[0]) if f.endswith('.mat')]
-        dat_temp = loadmat(os.path.join(data_dir+fchar+classList[0], f_temp[0]))['val'].astype(np.float32).ravel()
-        data = np.empty((0,dat_temp.shape[0]))
-        class_g = []
-        for foldername in classList:
-            data_files = [f for f in os.listdir(data_dir+fchar+foldername) if f.endswith('.mat')]
-            data_list_local = []
-            class_list_local = []
-            for fname in data_files:
-                exp_data = loadmat(os.path.join(data_dir+fchar+foldername, fname))['val'].astype(np.float32).ravel()
-                exp_data = (exp_data - np.mean(exp_data)) / np.std(exp_data) # normalize for numerical stability
-                data_list_local.append(exp_data)
-                class_list_local.append(foldername)
-            data_l = np.stack(data_list_local)
-            class_l = np.stack(class_list_local)
-            data = np.concatenate((data,data_l))
-            class_g = np.concatenate((class_g,class_l))
-        print('Loaded dataset.')
-        return data, class_g, len(classList)
+        return data, classList[class_codes], len(classList)
     
           
 
 class DataLoader(object):
-    def __init__(self, data, batch_size=128, num_steps=1):
+    # True for the first window of a batch, where the recurrent state starts from zero
+    starts_batch = False
+    # weights of the targets of the current window, None when they all count
+    batch_mask = None
+    # class codes of the sequences of the current window, None when no classes were given
+    batch_classes = None
+
+    # classes - class code of every sequence, for class-conditional models
+    # seed - unused, the first batch is always the same; taken for the interface of the other loaders
+    def __init__(self, data, batch_size=128, num_steps=1, classes=None, seed=None):
         self.batch_size = batch_size
         self.n_data, self.seq_len = data.shape
         #num_batches = (self.n_data // self.batch_size) * self.batch_size
         self._data = data[:self.batch_size , :]
+        if classes is not None:
+            self.batch_classes = np.asarray(classes)[:self.batch_size]
         
         self.num_steps = num_steps
         self._data = self._data.reshape((self.batch_size, self.seq_len, 1))
@@ -89,13 +425,217 @@ class DataLoader(object):
     def reset(self):
         self._reset_pointer()
 
+    def close(self):
+        """ Releases what the loader holds between epochs, nothing here. """
+
     def has_next(self):
         return self.pointer + self.num_steps < self.seq_len - 1
 
     def next_batch(self):
+        self.starts_batch = self.pointer == 0
         batch_xs = self._data[:, self.pointer:self.pointer+self.num_steps, :]
         batch_ys = self._data[:, self.pointer+1:self.pointer+self.num_steps+1, :]
         self.pointer = self.pointer + self.num_steps
         return batch_xs, batch_ys
+
+
+_END_OF_EPOCH = object()
+
+
+class ShuffledDataLoader(DataLoader):
+    """ Iterates over every sequence of data once per epoch.
+    The sequences are shuffled into minibatches of batch_size (the last one is
+    topped up with sequences already seen in the epoch) and every minibatch is
+    cut into num_steps windows for truncated backpropagation through time.
+    starts_batch tells the model when to reset its recurrent state. A
+    background thread, started by the first has_next() of an epoch, gathers
+    the next windows while the current one is trained on; close() stops it.
+    """
+    def __init__(self, data, batch_size=128, num_steps=1, prefetch=8, seed=None, classes=None):
+        self.batch_size = batch_size
+        self.n_data, self.seq_len = data.shape
+        self.num_steps = num_steps
+        self.num_batches = -(-self.n_data // self.batch_size)
+        self._data = data
+        self._classes = None if classes is None else np.asarray(classes)
+        self._rng = np.random.RandomState(seed)
+        self._prefetch = prefetch
+        self._thread = None
+        self._reset_pointer()
+
+    def _epoch_batches(self):
+        """ Returns the sequences of every minibatch of an epoch, one row per minibatch. """
+        order = self._rng.permutation(self.n_data)
+        return np.resize(order, (self.num_batches, self.batch_size))
+
+    def _reset_pointer(self):
+        # the producer of the epoch is only started by has_next, so a loader that is reset before it is
+        # iterated (as train_for_epoch does) does not gather an epoch it throws away
+        self._stop_thread()
+        self._next = None
+
+    def _start_thread(self):
+        order = self._epoch_batches()
+        self._queue = queue.Queue(self._prefetch)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._produce, args=(order, self._queue, self._stop), daemon=True)
+        self._thread.start()
+
+    def _stop_thread(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def close(self):
+        """ Stops the producer of an epoch that was not iterated to its end. """
+        self._stop_thread()
+
+    def _put(self, item, batches, stop):
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _batch_classes(self, index):
+        return None if self._classes is None else self._classes[index]
+
+    def _windows(self, order):
+        for index in order:
+            batch = self._data[index][:, :, None]
+            classes = self._batch_classes(index)
+            pointer = 0
+            while pointer + self.num_steps < self.seq_len - 1:
+                yield (batch[:, pointer:pointer+self.num_steps, :],
+                       batch[:, pointer+1:pointer+self.num_steps+1, :],
+                       pointer == 0,
+                       None,
+                       classes)
+                pointer = pointer + self.num_steps
+
+    def _produce(self, order, batches, stop):
+        try:
+            for window in self._windows(order):
+                if not self._put(window, batches, stop):
+                    return
+        except Exception as e: # handed over to the training thread by next_batch
+            self._put(e, batches, stop)
+            return
+        self._put(_END_OF_EPOCH, batches, stop)
+
+    def has_next(self):
+        if self._thread is None:
+            self._start_thread()
+        if self._next is None:
+            self._next = self._queue.get()
+        return self._next is not _END_OF_EPOCH
+
+    def next_batch(self):
+        if not self.has_next():
+            raise StopIteration('epoch is over, call reset()')
+        if isinstance(self._next, Exception):
+            raise self._next
+        batch_xs, batch_ys, self.starts_batch, self.batch_mask, self.batch_classes = self._next
+        self._next = None
+        return batch_xs, batch_ys
+
+
+class BucketedDataLoader(ShuffledDataLoader):
+    """ Iterates over sequences of different lengths, given as a RaggedArray.
+    Every epoch the sequences are sorted by length (ties in random order) and
+    cut into minibatches of batch_size, so a minibatch holds sequences of
+    similar lengths and each of them is padded only up to the longest one of
+    its minibatch. batch_mask is 0 for the padded targets, so padding does not
+    count in the loss and every sample of every sequence is trained on. The
+    minibatches are visited in shuffled order and cut into num_steps windows
+    as in ShuffledDataLoader.
+    """
+    def __init__(self, data, batch_size=128, num_steps=1, prefetch=8, seed=None, classes=None):
+        if not isinstance(data, RaggedArray):
+            data = RaggedArray(np.ravel(data), np.arange(data.shape[0] + 1, dtype=np.int64) * data.shape[1])
+        self.batch_size = batch_size
+        self.n_data = len(data)
+        self._lengths = data.lengths
+        self.seq_len = int(self._lengths.max())
+        self.num_steps = num_steps
+        self.num_batches = -(-self.n_data // self.batch_size)
+        self._data = data
+        self._classes = None if classes is None else np.asarray(classes)
+        self._rng = np.random.RandomState(seed)
+        self._prefetch = prefetch
+        self._thread = None
+        self._reset_pointer()
+
+    def _epoch_batches(self):
+        order = np.lexsort((self._rng.random_sample(self.n_data), self._lengths))
+        # the last minibatch is topped up with its own (longest) sequences
+        batches = [np.resize(order[i:i+self.batch_size], self.batch_size) for i in range(0, self.n_data, self.batch_size)]
+        return [batches[i] for i in self._rng.permutation(len(batches))]
+
+    def _windows(self, order):
+        for index in order:
+            lengths = self._lengths[index]
+            num_windows = -(-(int(lengths.max()) - 1) // self.num_steps)
+            batch = np.zeros((self.batch_size, num_windows * self.num_steps + 1, 1), dtype=self._data.dtype)
+            for row, i in enumerate(index):
+                batch[row, :lengths[row], 0] = self._data[int(i)]
+            # the target at position t + 1 is real iff t + 1 < length
+            mask = (np.arange(1, batch.shape[1]) < lengths[:, None]).astype(np.float32)[:, :, None]
+            classes = self._batch_classes(index)
+            for pointer in range(0, num_windows * self.num_steps, self.num_steps):
+                yield (batch[:, pointer:pointer+self.num_steps, :],
+                       batch[:, pointer+1:pointer+self.num_steps+1, :],
+                       pointer == 0,
+                       mask[:, pointer:pointer+self.num_steps, :],
+                       classes)
+
+
+class WindowDataLoader(DataLoader):
+    """ Packs windows of num_steps samples taken from all sequences into batches.
+    The windows are a strided view of data (np.lib.stride_tricks), so only the
+    windows of the current batch are ever copied. Each window is trained on
+    as an independent example starting from an empty recurrent state, which
+    lets a single sess.run cover batch_size windows of any sequences.
+    Consecutive windows of a sequence start stride samples apart (num_steps by
+    default, stride=1 uses every overlapping window); all windows are visited
+    in shuffled order every epoch, the last batch being topped up with windows
+    already seen.
+    """
+    def __init__(self, data, batch_size=1024, num_steps=1, stride=None, seed=None, classes=None):
+        self.batch_size = batch_size
+        self.n_data, self.seq_len = data.shape
+        self.num_steps = num_steps
+        self._classes = None if classes is None else np.asarray(classes)
+        # (n_data, n_windows, num_steps + 1): every window holds its inputs and the next-step targets
+        self._windows = np.lib.stride_tricks.sliding_window_view(data, num_steps + 1, axis=1)[:, ::stride or num_steps]
+        self.n_windows = self._windows.shape[0] * self._windows.shape[1]
+        self.num_batches = -(-self.n_windows // self.batch_size)
+        self._rng = np.random.RandomState(seed)
+        self._reset_pointer()
+
+    def _reset_pointer(self):
+        self.pointer = 0
+        self._order = np.resize(self._rng.permutation(self.n_windows), self.num_batches * self.batch_size)
+
+    def has_next(self):
+        return self.pointer < self.num_batches
+
+    def next_batch(self):
+        self.starts_batch = True
+        index = self._order[self.pointer*self.batch_size:(self.pointer+1)*self.batch_size]
+        batch = self._windows[index // self._windows.shape[1], index % self._windows.shape[1]][:, :, None]
+        if self._classes is not None:
+            self.batch_classes = self._classes[index // self._windows.shape[1]]
+        self.pointer = self.pointer + 1
+        return batch[:, :-1, :], batch[:, 1:, :]
+
+
+DATA_LOADERS = {'first_batch': DataLoader,
+                'shuffle': ShuffledDataLoader,
+                'window': WindowDataLoader,
+                'bucket': BucketedDataLoader}
         
 
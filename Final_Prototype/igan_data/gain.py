@@ -23,7 +23,12 @@ from igan_data.utils import xavier_init
 from igan_data.utils import binary_sampler, uniform_sampler, sample_batch_index
 from scipy.signal import savgol_filter
 
-def gain_t(data_x, gain_parameters,inp_data):
+# training iterations between two calls of the progress callback of gain_t
+PROGRESS_INTERVAL = 100
+
+# progress - called every PROGRESS_INTERVAL iterations with keyword arguments iteration and iterations,
+# it may raise an exception to stop training
+def gain_t(data_x, gain_parameters,inp_data, progress=None):
     # Define mask matrix
     data_m = 1-np.isnan(data_x)
 
@@ -149,6 +154,8 @@ def gain_t(data_x, gain_parameters,inp_data):
         _, G_loss_curr, MSE_loss_curr = \
         sess.run([G_solver, G_loss_temp, MSE_loss],
              feed_dict = {X: X_mb, M: M_mb, H: H_mb})
+        if progress is not None and ((it+1) % PROGRESS_INTERVAL == 0 or it+1 == iterations):
+            progress(iteration=it+1, iterations=iterations)
 
     no, dim = inp_data.shape
     Z_mb = uniform_sampler(0, 0.01, no, dim)
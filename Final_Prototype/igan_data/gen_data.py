@@ -12,11 +12,14 @@ warnings.filterwarnings('ignore')
 import igan_data.data_utils
 import igan_data.model_utils
 import igan_data.model
+import igan_data.model_registry
+import igan_data.numpy_sampler
 import tensorflow as tf
 tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.FATAL)
 import numpy as np
-import glob
-import os, shutil
+import functools
+import multiprocessing
+import os, queue, time
 
 # hyperparameters: 1. dataset file (numpy) 2. data type (.mat or .csv) 3. number of synthetic sequences to be generated 
 # 4. at what epochs to save model 5. training epoch 6. model output dir
@@ -24,8 +27,19 @@ import os, shutil
 
 LOG_FILE = 'tensorflow_logger.txt'
 LOG_PATH = 'server_data'
+# windows trained on per sess.run with loader='window'
+WINDOW_BATCH_SIZE = 1024
+# sequences sampled in lockstep by iter_gen_data_multiclass, small so the first ones are ready soon
+STREAM_BLOCK_SIZE = 4
+
+# set in the worker processes of gen_data_multiclass, which hand their messages to the parent
+_log_queue = None
+_log_prefix = ''
 
 def log_gen_msg(path_to_logger, msg):
+    if _log_queue is not None:
+        _log_queue.put(_log_prefix + msg)
+        return
     with open(path_to_logger, "a") as f:
         msg = msg + "\n"
         f.write(msg)
@@ -35,106 +49,601 @@ def clean_logger(path_to_logger):
     open(path_to_logger, "w").close()
 
 
+# indices of the sequences to train on and to hold out: a random holdout fraction of them,
+# at least one if holdout > 0 and always leaving one to train on
+def _holdout_split(n, holdout, seed=None):
+    num_holdout = min(max(int(round(n * holdout)), 1), n - 1) if holdout > 0 and n > 1 else 0
+    order = np.random.RandomState(seed).permutation(n)
+    return np.sort(order[num_holdout:]), np.sort(order[:num_holdout])
+
+
+def _close_loaders(*loaders):
+    # stops the producer threads of an epoch cut short by an error
+    for loader in loaders:
+        if loader is not None:
+            loader.close()
+
+
+def _train_model(engine, loader, num_epochs, path_to_logger, holdout_loader=None,
+                 patience=None, min_delta=0.0, out_dir=None, model_chkpoint=None, time_budget=None,
+                 first_epoch=0, progress=None):
+    """ Trains engine.train_model from epoch first_epoch (when resuming a
+    stored model) up to num_epochs. With patience set, training stops once
+    the loss (on holdout_loader if given, else on the training data) has not
+    improved by more than min_delta for patience epochs, and the weights of
+    the best epoch are restored. With time_budget set, training stops before
+    an epoch that would end after time_budget seconds, judging by the mean
+    duration of the epochs so far. Returns the training loss of the epoch
+    whose weights are kept, the training losses of all epochs run, the
+    number of epochs the kept weights stand for: num_epochs, or fewer if the
+    time ran out first (so that a later run can carry on from there) or
+    training stopped early, and whether it stopped early.
+    progress is called after every epoch, see gen_data_GAN.
+    """
+    sess = engine.sess
+    best_loss, best_weights, best_epoch, wait = np.inf, None, None, 0
+    losses = []
+    epochs_done, stopped_early = num_epochs, False
+    start = time.time()
+    for idx in range(first_epoch, num_epochs):
+        epoch_loss = engine.train_model.train_for_epoch(sess, loader)
+        losses.append(epoch_loss)
+        text_msg = 'Epoch: ' + str(idx) + ' Loss: ' + str(epoch_loss)
+        if holdout_loader is not None:
+            holdout_loss = engine.train_model.eval_for_epoch(sess, holdout_loader)
+            text_msg += ' Holdout loss: ' + str(holdout_loss)
+        log_gen_msg(path_to_logger, text_msg)
+        if progress is not None:
+            progress(epoch=idx+1, num_epochs=num_epochs, loss=float(epoch_loss))
+        if out_dir is not None and ((idx+1) % model_chkpoint == 0 or idx+1 == num_epochs):
+            engine.saver.save(sess, os.path.join(out_dir, 'GAN_models.ckpt'), global_step=idx)
+        if patience is not None:
+            monitored_loss = holdout_loss if holdout_loader is not None else epoch_loss
+            if monitored_loss < best_loss - min_delta:
+                best_loss, best_weights, best_epoch, wait = monitored_loss, engine.get_weights(), (idx, epoch_loss), 0
+            else:
+                wait += 1
+                if wait >= patience:
+                    log_gen_msg(path_to_logger, 'Stopping early, no improvement for ' + str(patience) + ' epochs')
+                    stopped_early = True
+                    break
+        elapsed, epochs_run = time.time() - start, len(losses)
+        if time_budget is not None and idx+1 < num_epochs and elapsed * (epochs_run+1) / epochs_run > time_budget:
+            log_gen_msg(path_to_logger, 'Stopping after ' + str(idx+1) + ' epochs, the time limit of '
+                        + str(round(time_budget, 1)) + 's is reached')
+            epochs_done = idx+1
+            break
+    if best_weights is not None and best_epoch[0] != idx:
+        engine.set_weights(best_weights)
+        idx, epoch_loss = best_epoch
+        epochs_done = min(epochs_done, idx+1)
+        log_gen_msg(path_to_logger, 'Restored the weights of epoch ' + str(idx))
+        if out_dir is not None:
+            engine.saver.save(sess, os.path.join(out_dir, 'GAN_models.ckpt'), global_step=idx)
+    return epoch_loss, losses, epochs_done, stopped_early
+
+
+def _fit_GAN(data, data_type='.mat', model_chkpoint=100, num_epochs=200, batch_size=128, out_dir=None,
+             loader='first_batch', seq_len=None, patience=None, min_delta=0.0, holdout=0.0, time_budget=None,
+             registry=None, label=None, seed=None, progress=None):
+    """ Trains (or loads from the registry) the model of gen_data_GAN, which
+    takes the same arguments but num_seq. Returns a numpy_sampler.NumpySampler of the
+    trained weights, the training loss and the length of the sequences to
+    generate.
+    """
+    path_to_logger = os.path.join(LOG_PATH, LOG_FILE)
+    if isinstance(data, igan_data.data_utils.RaggedArray):
+        loader = 'bucket'
+    if seq_len is None:
+        seq_len = int(igan_data.data_utils.sequence_lengths(data).max())
+    if registry is not None:
+        data_hash = igan_data.model_registry.dataset_hash(data)
+    train_index, holdout_index = _holdout_split(len(data), holdout, seed)
+    if len(holdout_index):
+        data, holdout_data = data[train_index], data[holdout_index]
+        # a window batch (WINDOW_BATCH_SIZE) does not depend on the number of sequences
+        if loader != 'window':
+            batch_size = min(batch_size, len(data))
+    #data = data_utils.load_training_data(data_dir,data_type)
+    if out_dir is not None:
+        os.makedirs(out_dir, exist_ok=True)
+    train_config = igan_data.model.ModelConfig()
+    test_config = igan_data.model.ModelConfig()
+    #the following variables will be hypermaters in final project too.
+    train_config.learning_rate = 0.003
+    train_config.num_layers = 1
+    train_config.batch_size = batch_size
+    test_config.num_layers = 1
+    test_config.batch_size = None
+    test_config.num_steps = 1
+    # the graphs are built once per configuration, every class only re-initialises the variables
+    engine = igan_data.model.get_engine(train_config, test_config)
+    engine.reset()
+    stored = None
+    if registry is not None:
+        registry_key = registry.key(data_hash, label, train_config, seed, loader=loader,
+                                    patience=patience, min_delta=min_delta, holdout=holdout)
+        stored = registry.load(registry_key, num_epochs)
+    first_epoch, losses = 0, []
+    if stored is not None:
+        # weights and optimizer state of the stored run, which carries on from where it stopped
+        weights, info = stored
+        engine.set_weights(weights)
+        first_epoch, losses, epoch_loss = info['epochs'], info['losses'], info['loss']
+        # a run that stopped early is complete, training it for more epochs would stop again
+        if info.get('stopped_early'):
+            first_epoch = num_epochs
+    if first_epoch == num_epochs:
+        text_msg = 'Using the stored model trained on this data, loss: ' + str(epoch_loss)
+        log_gen_msg(path_to_logger, text_msg)
+    else:
+        holdout_loader = None
+        if len(holdout_index):
+            # the holdout sequences are batched like the training ones, first_batch would only see some of them
+            holdout_loader = igan_data.data_utils.DATA_LOADERS['shuffle' if loader == 'first_batch' else loader](
+                data=holdout_data, batch_size=train_config.batch_size, num_steps=train_config.num_steps, seed=seed)
+        train_loader = igan_data.data_utils.DATA_LOADERS[loader](data=data,batch_size=train_config.batch_size, num_steps=train_config.num_steps, seed=seed)
+        if first_epoch:
+            text_msg = 'Resuming the stored model trained for ' + str(first_epoch) + ' epochs...'
+        else:
+            text_msg = 'Training current model...'
+        log_gen_msg(path_to_logger, text_msg)
+        try:
+            epoch_loss, new_losses, epochs_done, stopped_early = _train_model(
+                engine, train_loader, num_epochs, path_to_logger, holdout_loader=holdout_loader, patience=patience,
+                min_delta=min_delta, out_dir=out_dir, model_chkpoint=model_chkpoint, time_budget=time_budget,
+                first_epoch=first_epoch, progress=progress)
+        finally:
+            _close_loaders(train_loader, holdout_loader)
+        # the losses of the epochs the kept weights stand for, not of the epochs run after the best one
+        losses = (losses + [float(loss) for loss in new_losses])[:epochs_done]
+        text_msg = 'Done training current model.'
+        log_gen_msg(path_to_logger, text_msg)
+        if registry is not None:
+            registry.store(registry_key, engine.get_weights(),
+                           {'epochs': epochs_done, 'loss': float(epoch_loss), 'losses': losses,
+                            'stopped_early': stopped_early})
+    # the trained weights are sampled from in numpy
+    return igan_data.numpy_sampler.NumpySampler(engine.get_weights()), epoch_loss, seq_len
+
+
+def _sample_blocks(sampler, num_seq, seq_len, block_size, classes=None, seed=None, progress=None):
+    """ Samples num_seq sequences of seq_len from sampler block_size
+    sequences at a time, yielding the index of the first sequence of every
+    block and the block. Sequence i is the same whatever the block size,
+    see numpy_sampler.MixtureSampler. classes - class code of every
+    sequence for a class-conditional sampler.
+    """
+    for start in range(0, num_seq, block_size):
+        stop = min(start + block_size, num_seq)
+        block_classes = None if classes is None else classes[start:stop]
+        yield start, sampler.sample(stop - start, seq_len, block_classes, seed=seed, first_index=start)
+        if progress is not None:
+            progress(sample=stop, num_seq=num_seq)
+
+
 def gen_data_GAN(data, 
                  data_type = '.mat', 
                  num_seq = 10, 
                  model_chkpoint = 100,
                  num_epochs = 200,
                  batch_size = 128,
-                 out_dir = 'models/'):
+                 out_dir = None,
+                 loader = 'first_batch',
+                 seq_len = None,
+                 patience = None,
+                 min_delta = 0.0,
+                 holdout = 0.0,
+                 time_budget = None,
+                 registry = None,
+                 label = None,
+                 seed = None,
+                 progress = None):
+    # loader: 'first_batch' trains on the first batch_size sequences only,
+    # 'shuffle' on all of them in shuffled minibatches and 'window' on
+    # batch_size windows of num_steps samples at a time (see data_utils.DATA_LOADERS)
+    # data can also be a data_utils.RaggedArray of sequences of different
+    # lengths; these are always batched by length with the 'bucket' loader
+    # seq_len: length of the generated sequences, the longest training sequence by default
+    # out_dir: directory to keep checkpoints in, saved every model_chkpoint epochs and after
+    # the last one; the sampling model reads the trained weights from memory either way
+    # patience, min_delta: stop once the loss has not improved by more than min_delta for
+    # patience epochs and keep the best weights, None trains for all num_epochs
+    # holdout: fraction of the sequences held out of training to measure that loss on
+    # time_budget: seconds training may take, at least one epoch is always trained
+    # registry: model_registry.ModelRegistry to reuse a model trained on the same data (of class label)
+    # with the same settings instead of training it again, and to store newly trained models in;
+    # a model stored with fewer epochs is trained on for the missing ones only
+    # seed: seed of the holdout split, of the order the loader visits the data in and of the sampled
+    # sequences, each of which gets random streams of its own (see numpy_sampler.MixtureSampler)
+    # progress: called with keyword arguments after every epoch (epoch, num_epochs, loss) and every
+    # block of generated sequences (sample, num_seq); it may raise an exception to cancel the generation
     path_to_logger = os.path.join(LOG_PATH, LOG_FILE)
-    #data = data_utils.load_training_data(data_dir,data_type)
-    igan_data.model_utils.reset_session_and_model()
-    with tf.Session() as sess:
-        train_config = igan_data.model.ModelConfig()
-        test_config = igan_data.model.ModelConfig()
-        #the following variables will be hypermaters in final project too.
-        train_config.learning_rate = 0.003
-        train_config.num_layers = 1
-        train_config.batch_size = batch_size
-        test_config.num_layers = 1
-        test_config.batch_size = 1
-        test_config.num_steps = 1
-        loader = igan_data.data_utils.DataLoader(data=data,batch_size=train_config.batch_size, num_steps=train_config.num_steps)
-        train_model = igan_data.model.MDNModel(train_config, True)
-        test_model = igan_data.model.MDNModel(test_config, False)
-        sess.run(tf.global_variables_initializer())
-        saver = tf.train.Saver()
-        text_msg = 'Training current model...'
-        log_gen_msg(path_to_logger, text_msg)
-        for idx in range(num_epochs):
-            epoch_loss = train_model.train_for_epoch(sess, loader)
-            text_msg = 'Epoch: ' + str(idx) + ' Loss: ' + str(epoch_loss)
-            log_gen_msg(path_to_logger, text_msg)
-            if (idx+1) % model_chkpoint== 0:
-                saver.save(sess, out_dir + 'GAN_models.ckpt', global_step=idx)
-        text_msg = 'Done training current model.'
-        log_gen_msg(path_to_logger, text_msg)
-    ckpt_path = out_dir + 'GAN_models.ckpt-'+str(num_epochs-model_chkpoint)
-    igan_data.model_utils.reset_session_and_model()
-    fake_list = []
+    sampler, epoch_loss, seq_len = _fit_GAN(data, data_type=data_type, model_chkpoint=model_chkpoint,
+                                            num_epochs=num_epochs, batch_size=batch_size, out_dir=out_dir,
+                                            loader=loader, seq_len=seq_len, patience=patience,
+                                            min_delta=min_delta, holdout=holdout, time_budget=time_budget,
+                                            registry=registry, label=label, seed=seed, progress=progress)
     text_msg = 'Generating synthetic data for current class...'
     log_gen_msg(path_to_logger, text_msg)
-    with tf.Session() as sess:
-        test_config = igan_data.model.ModelConfig()
-        test_config.num_layers = 1
-        test_config.batch_size = 1
-        test_config.num_steps = 1
-        test_model = igan_data.model.MDNModel(test_config, True)
-        test_model.is_training = False
-        sess.run(tf.global_variables_initializer())
-        saver = tf.train.Saver()
-        list_of_files = glob.glob(out_dir+'*')
-        latest_file = max(list_of_files, key=os.path.getctime)
-        t = [pos for pos, char in enumerate(latest_file) if char == '.']
-        l, r = latest_file[:t[-1]], latest_file[t[-1]:]
-        saver.restore(sess, l)
-        for i in range(num_seq):
-            fake_data = test_model.predict(sess, data.shape[1])
-            fake_list.append(fake_data)
-    fake_list = np.array(fake_list) #returns num_seq x data.shape[0] numpy array
+    fake_list = np.empty((num_seq, seq_len), dtype=np.float32) #returns num_seq x data.shape[0] numpy array
+    for start, block in _sample_blocks(sampler, num_seq, seq_len, igan_data.numpy_sampler.SAMPLE_BATCH_SIZE, seed=seed, progress=progress):
+        fake_list[start:start+len(block)] = block
     text_msg = 'Data generated for current class'
     log_gen_msg(path_to_logger, text_msg)
-    shutil.rmtree('models/')
-    os.mkdir('models/')
     return fake_list, epoch_loss
 
 
+# task - (class name, keyword arguments of gen_data_GAN)
+def _train_class(task):
+    global _log_prefix
+    name, kwargs = task
+    if _log_queue is not None:
+        _log_prefix = 'Class ' + name + ': '
+    log_gen_msg(os.path.join(LOG_PATH, LOG_FILE), "Training for class " + name)
+    return gen_data_GAN(**kwargs)
+
+
+# task - (class name, keyword arguments of gen_data_GAN), trains the model of the class without sampling from it
+def _fit_class(task):
+    global _log_prefix
+    name, kwargs = task
+    if _log_queue is not None:
+        _log_prefix = 'Class ' + name + ': '
+    log_gen_msg(os.path.join(LOG_PATH, LOG_FILE), "Training for class " + name)
+    kwargs = dict(kwargs)
+    del kwargs['num_seq']
+    return _fit_GAN(**kwargs)
+
+
+def _init_train_worker(log_queue, num_threads):
+    global _log_queue
+    _log_queue = log_queue
+    igan_data.model.SESSION_CONFIG = tf.ConfigProto(intra_op_parallelism_threads=num_threads,
+                                                    inter_op_parallelism_threads=1)
+
+
+# logs the messages the workers have sent so far
+def _drain_log_queue(log_queue, path_to_logger):
+    while True:
+        try:
+            log_gen_msg(path_to_logger, log_queue.get_nowait())
+        except queue.Empty:
+            return
+
+
+def _train_classes_parallel(tasks, num_workers, path_to_logger, progress=None, train_fn=_train_class):
+    """ Runs train_fn on every task in num_workers processes, each with
+    its own TF runtime limited to its share of the cores, and returns the
+    results in task order. The messages of the workers are logged here as
+    they arrive. Processes are spawned, not forked, as TF is not fork-safe.
+    progress is only called to give it a chance to cancel, the pool is
+    terminated if it raises.
+    """
+    ctx = multiprocessing.get_context('spawn')
+    log_queue = ctx.Queue()
+    num_threads = max(1, multiprocessing.cpu_count() // num_workers)
+    with ctx.Pool(num_workers, initializer=_init_train_worker, initargs=(log_queue, num_threads)) as pool:
+        results = pool.map_async(train_fn, tasks, chunksize=1)
+        while not results.ready():
+            _drain_log_queue(log_queue, path_to_logger)
+            if progress is not None:
+                progress(stage='training classes in parallel')
+            results.wait(0.2)
+        _drain_log_queue(log_queue, path_to_logger)
+        return results.get()
+
+
+def _class_tasks(data, classL, num_classes, num_seq, data_type, model_chkpoint, num_epochs, loader, out_dir,
+                 patience, min_delta, holdout, registry):
+    """ Returns the class names, the length of the sequences to generate,
+    the size of every class and a (class name, keyword arguments of
+    gen_data_GAN) task for every class, see gen_data_multiclass. """
+    class_names, class_index = np.unique(classL, return_inverse=True)
+    # every class generates sequences as long as the longest training sequence
+    seq_len = int(igan_data.data_utils.sequence_lengths(data).max())
+    class_sizes = np.bincount(class_index, minlength=num_classes)
+    tasks = []
+    for i in range(num_classes):
+        members = np.flatnonzero(class_index == i)
+        # the samples of a class need not be contiguous (e.g. after appending data),
+        # a contiguous class is sliced without a copy
+        if members[-1] - members[0] + 1 == len(members):
+            class_data = data[members[0]:members[-1]+1]
+        else:
+            class_data = data[members]
+        if loader == 'window':
+            batch_size = WINDOW_BATCH_SIZE
+        elif len(members) > 128:
+            batch_size = 128
+        else:
+            batch_size = len(members)
+        tasks.append((str(class_names[i]), dict(data = class_data,
+                     data_type = data_type,
+                     num_seq = num_seq[i],
+                     model_chkpoint = model_chkpoint,
+                     num_epochs = num_epochs,
+                     batch_size = batch_size,
+                     out_dir = None if out_dir is None else os.path.join(out_dir, 'class_' + str(i)),
+                     loader = loader,
+                     seq_len = seq_len,
+                     patience = patience,
+                     min_delta = min_delta,
+                     holdout = holdout,
+                     registry = registry,
+                     label = class_names[i])))
+    return class_names, seq_len, class_sizes, tasks
+
+
+# sets the share of the time budget and the progress callback of the i-th of tasks trained one after another
+def _prepare_serial_task(i, tasks, class_sizes, start, time_budget, progress):
+    name, kwargs = tasks[i]
+    if time_budget is not None:
+        # share what is left of the budget, so time a class leaves unused goes to the next ones
+        kwargs['time_budget'] = (time_budget - (time.time() - start)) * class_sizes[i] / class_sizes[i:].sum()
+    if progress is not None:
+        kwargs['progress'] = functools.partial(progress, class_index=i+1, num_classes=len(tasks),
+                                               **{'class': name})
+
+
+def _run_tasks(tasks, class_sizes, num_workers, start, time_budget, path_to_logger, progress, train_fn):
+    """ Runs train_fn on every task, in parallel if num_workers > 1, and
+    returns the results in task order. time_budget counts from start. """
+    if num_workers > 1:
+        if time_budget is not None:
+            # every worker trains its classes one after another within the whole budget; a class runs on
+            # one worker, so its share never exceeds what is left of the budget
+            remaining = max(time_budget - (time.time() - start), 0.0)
+            for (_, kwargs), size in zip(tasks, class_sizes):
+                kwargs['time_budget'] = min(remaining, remaining * num_workers * size / class_sizes.sum())
+        return _train_classes_parallel(tasks, num_workers, path_to_logger, progress, train_fn)
+    results = []
+    for i, task in enumerate(tasks):
+        _prepare_serial_task(i, tasks, class_sizes, start, time_budget, progress)
+        results.append(train_fn(task))
+    return results
+
+
 def gen_data_multiclass(data,
                         classL,
                         num_classes,
                         num_seq,
                         data_type='.mat',
                         model_chkpoint=5,
-                        num_epochs=150):
+                        num_epochs=150,
+                        loader='first_batch',
+                        conditional=False,
+                        num_workers=1,
+                        out_dir=None,
+                        patience=None,
+                        min_delta=0.0,
+                        holdout=0.0,
+                        time_budget=None,
+                        registry=None,
+                        progress=None):
+    # conditional: train a single class-conditional model on all classes instead of one model per class
+    # num_workers: number of processes the per-class models are trained in, None for one per core
+    # out_dir: directory to keep the checkpoints of every class in, in a subdirectory per class
+    # patience, min_delta, holdout: early stopping of every model, see gen_data_GAN
+    # time_budget: seconds all of the generation may take, shared by the classes in proportion to their size
+    # registry: model_registry.ModelRegistry the model of every class is looked up in and stored in
+    # progress: see gen_data_GAN, it is also given the class, class_index and num_classes being trained
+    if conditional:
+        return gen_data_conditional(data, classL, num_classes, num_seq, data_type=data_type,
+                                    num_epochs=num_epochs, loader=loader,
+                                    patience=patience, min_delta=min_delta, holdout=holdout,
+                                    time_budget=time_budget, progress=progress)
     path_to_logger = os.path.join(LOG_PATH, LOG_FILE)
     clean_logger(path_to_logger)
 
-    _, indices = np.unique(classL, return_index=True)
-    indices = np.append(indices,data.shape[0])
-    syndata_list =  np.empty((0,data.shape[1]))
+    if num_workers is None:
+        num_workers = multiprocessing.cpu_count()
+    num_workers = min(num_workers, num_classes)
+    start = time.time()
+    class_names, seq_len, class_sizes, tasks = _class_tasks(data, classL, num_classes, num_seq, data_type,
+                                                            model_chkpoint, num_epochs, loader, out_dir,
+                                                            patience, min_delta, holdout, registry)
+    results = _run_tasks(tasks, class_sizes, num_workers, start, time_budget, path_to_logger, progress, _train_class)
+    syndata_list =  np.empty((0,seq_len))
     class_list = []
     avg_loss = 0
-    for i in range(num_classes):
-        if indices[i+1]-indices[i] > 128:
-            batch_size = 128
-        else:
-            batch_size = indices[i+1]-indices[i]
-        text_msg = "Training for class " + str(classL[indices[i]])
-        log_gen_msg(path_to_logger, text_msg)
-        synthesized_data, my_loss = gen_data_GAN(data = data[indices[i]:indices[i+1],:],
-                     data_type = data_type,
-                     num_seq = num_seq[i],
-                     model_chkpoint = model_chkpoint,
-                     num_epochs = num_epochs,
-                     batch_size = batch_size,
-                     out_dir = 'models/')
+    for i, (synthesized_data, my_loss) in enumerate(results):
         avg_loss += my_loss
         syndata_list = np.concatenate((syndata_list,synthesized_data))
-        class_list.append(np.repeat(classL[indices[i]],num_seq[i]))
+        class_list.append(np.repeat(class_names[i],num_seq[i]))
     text_msg = "Data generation for all classes complete"
     log_gen_msg(path_to_logger, text_msg)
     clean_logger(path_to_logger)
     class_list = np.concatenate(class_list).ravel()
     my_loss = avg_loss/num_classes
-    return syndata_list, class_list, num_classes, my_loss
\ No newline at end of file
+    return syndata_list, class_list, num_classes, my_loss
+
+
+def gen_data_conditional(data,
+                         classL,
+                         num_classes,
+                         num_seq,
+                         data_type='.mat',
+                         num_epochs=150,
+                         loader='shuffle',
+                         batch_size=128,
+                         patience=None,
+                         min_delta=0.0,
+                         holdout=0.0,
+                         time_budget=None,
+                         progress=None):
+    # trains one MDN model conditioned on the class of every sequence on all
+    # classes at once, then samples the sequences of all classes in one batch;
+    # arguments and results are those of gen_data_multiclass
+    path_to_logger = os.path.join(LOG_PATH, LOG_FILE)
+    clean_logger(path_to_logger)
+    sampler, class_names, seq_len, epoch_loss = _fit_conditional(data, classL, num_classes, num_epochs=num_epochs,
+                                                                 loader=loader, batch_size=batch_size,
+                                                                 patience=patience, min_delta=min_delta,
+                                                                 holdout=holdout, time_budget=time_budget,
+                                                                 progress=progress)
+    text_msg = 'Generating synthetic data for all classes...'
+    log_gen_msg(path_to_logger, text_msg)
+    classes = np.repeat(np.arange(num_classes), num_seq[:num_classes])
+    syndata_list = sampler.sample(len(classes), seq_len, classes)
+    text_msg = "Data generation for all classes complete"
+    log_gen_msg(path_to_logger, text_msg)
+    clean_logger(path_to_logger)
+    return syndata_list, class_names[classes], num_classes, epoch_loss
+
+
+def _fit_conditional(data, classL, num_classes, num_epochs=150, loader='shuffle', batch_size=128,
+                     patience=None, min_delta=0.0, holdout=0.0, time_budget=None, progress=None):
+    """ Trains the model of gen_data_conditional, which takes the same
+    arguments but num_seq and data_type. Returns a numpy_sampler.NumpySampler of the trained weights,
+    the class names (in the order of the class codes the sampler takes),
+    the length of the sequences to generate and the training loss.
+    """
+    path_to_logger = os.path.join(LOG_PATH, LOG_FILE)
+    class_names, class_codes = np.unique(classL, return_inverse=True)
+    # the default loader of gen_data_multiclass only ever sees the first batch of sequences, the sequences
+    # are ordered by class so the model would only learn the first few classes
+    if loader == 'first_batch':
+        loader = 'shuffle'
+    if isinstance(data, igan_data.data_utils.RaggedArray):
+        loader = 'bucket'
+    seq_len = int(igan_data.data_utils.sequence_lengths(data).max())
+    train_index, holdout_index = _holdout_split(len(data), holdout)
+    if len(holdout_index):
+        data, holdout_data = data[train_index], data[holdout_index]
+        holdout_codes, class_codes = class_codes[holdout_index], class_codes[train_index]
+    train_config = igan_data.model.ModelConfig()
+    test_config = igan_data.model.ModelConfig()
+    train_config.learning_rate = 0.003
+    train_config.num_layers = 1
+    train_config.batch_size = WINDOW_BATCH_SIZE if loader == 'window' else min(batch_size, len(data))
+    train_config.num_classes = len(class_names)
+    test_config.num_layers = 1
+    test_config.batch_size = None
+    test_config.num_steps = 1
+    test_config.num_classes = len(class_names)
+    engine = igan_data.model.get_engine(train_config, test_config)
+    engine.reset()
+    holdout_loader = None
+    if len(holdout_index):
+        holdout_loader = igan_data.data_utils.DATA_LOADERS['shuffle' if loader == 'first_batch' else loader](
+            data=holdout_data, batch_size=train_config.batch_size, num_steps=train_config.num_steps, classes=holdout_codes)
+    loader = igan_data.data_utils.DATA_LOADERS[loader](data=data, batch_size=train_config.batch_size,
+                                                       num_steps=train_config.num_steps, classes=class_codes)
+    text_msg = 'Training a model for all ' + str(num_classes) + ' classes...'
+    log_gen_msg(path_to_logger, text_msg)
+    try:
+        epoch_loss, _, _, _ = _train_model(engine, loader, num_epochs, path_to_logger, holdout_loader=holdout_loader,
+                                           patience=patience, min_delta=min_delta, time_budget=time_budget,
+                                           progress=progress)
+    finally:
+        _close_loaders(loader, holdout_loader)
+    return igan_data.numpy_sampler.NumpySampler(engine.get_weights()), class_names, seq_len, epoch_loss
+
+
+def iter_gen_data_multiclass(data,
+                             classL,
+                             num_classes,
+                             num_seq,
+                             data_type='.mat',
+                             model_chkpoint=5,
+                             num_epochs=150,
+                             loader='first_batch',
+                             conditional=False,
+                             num_workers=1,
+                             out_dir=None,
+                             patience=None,
+                             min_delta=0.0,
+                             holdout=0.0,
+                             time_budget=None,
+                             registry=None,
+                             progress=None,
+                             block_size=STREAM_BLOCK_SIZE):
+    # gen_data_multiclass as a generator of (class name, sequence, loss of the model it was sampled from):
+    # every class is trained, then its sequences are yielded block_size at a time as they are sampled,
+    # so the first ones can be looked at while the rest is still being generated; with num_workers > 1
+    # the classes are trained in parallel by gen_data_multiclass first and its results yielded afterwards
+    path_to_logger = os.path.join(LOG_PATH, LOG_FILE)
+    if num_workers is None:
+        num_workers = multiprocessing.cpu_count()
+    if not conditional and min(num_workers, num_classes) > 1:
+        syndata_list, class_list, _, loss = gen_data_multiclass(
+            data, classL, num_classes, num_seq, data_type=data_type, model_chkpoint=model_chkpoint,
+            num_epochs=num_epochs, loader=loader, num_workers=num_workers, out_dir=out_dir, patience=patience,
+            min_delta=min_delta, holdout=holdout, time_budget=time_budget, registry=registry, progress=progress)
+        for name, sequence in zip(class_list, syndata_list):
+            yield name, sequence, loss
+        return
+    clean_logger(path_to_logger)
+    if conditional:
+        sampler, class_names, seq_len, loss = _fit_conditional(data, classL, num_classes, num_epochs=num_epochs,
+                                                               loader=loader, patience=patience,
+                                                               min_delta=min_delta, holdout=holdout,
+                                                               time_budget=time_budget, progress=progress)
+        text_msg = 'Generating synthetic data for all classes...'
+        log_gen_msg(path_to_logger, text_msg)
+        classes = np.repeat(np.arange(num_classes), num_seq[:num_classes])
+        for start, block in _sample_blocks(sampler, len(classes), seq_len, block_size, classes, progress=progress):
+            for code, sequence in zip(classes[start:start+len(block)], block):
+                yield class_names[code], sequence, loss
+    else:
+        start = time.time()
+        class_names, seq_len, class_sizes, tasks = _class_tasks(data, classL, num_classes, num_seq, data_type,
+                                                                model_chkpoint, num_epochs, loader, out_dir,
+                                                                patience, min_delta, holdout, registry)
+        for i, (name, kwargs) in enumerate(tasks):
+            _prepare_serial_task(i, tasks, class_sizes, start, time_budget, progress)
+            sampler, loss, seq_len = _fit_class(tasks[i])
+            text_msg = 'Generating synthetic data for current class...'
+            log_gen_msg(path_to_logger, text_msg)
+            for _, block in _sample_blocks(sampler, kwargs['num_seq'], seq_len, block_size, progress=kwargs.get('progress')):
+                for sequence in block:
+                    yield class_names[i], sequence, loss
+    text_msg = "Data generation for all classes complete"
+    log_gen_msg(path_to_logger, text_msg)
+    clean_logger(path_to_logger)
+
+
+def fit_gen_data_multiclass(data,
+                            classL,
+                            num_classes,
+                            data_type='.mat',
+                            model_chkpoint=5,
+                            num_epochs=150,
+                            loader='first_batch',
+                            conditional=False,
+                            num_workers=1,
+                            out_dir=None,
+                            patience=None,
+                            min_delta=0.0,
+                            holdout=0.0,
+                            time_budget=None,
+                            registry=None,
+                            progress=None):
+    # trains the models of gen_data_multiclass (same arguments, but num_seq) without generating anything,
+    # so that sequences can be sampled later, only when they are needed; returns a numpy_sampler.NumpySampler
+    # for every class (the same class-conditional one for all of them if conditional), the class names,
+    # the length of the sequences to generate and the mean loss of the models
+    path_to_logger = os.path.join(LOG_PATH, LOG_FILE)
+    clean_logger(path_to_logger)
+    if conditional:
+        sampler, class_names, seq_len, loss = _fit_conditional(data, classL, num_classes, num_epochs=num_epochs,
+                                                               loader=loader, patience=patience,
+                                                               min_delta=min_delta, holdout=holdout,
+                                                               time_budget=time_budget, progress=progress)
+        samplers = [sampler] * num_classes
+    else:
+        if num_workers is None:
+            num_workers = multiprocessing.cpu_count()
+        num_workers = min(num_workers, num_classes)
+        start = time.time()
+        class_names, seq_len, class_sizes, tasks = _class_tasks(data, classL, num_classes, [0] * num_classes,
+                                                                data_type, model_chkpoint, num_epochs, loader,
+                                                                out_dir, patience, min_delta, holdout, registry)
+        results = _run_tasks(tasks, class_sizes, num_workers, start, time_budget, path_to_logger, progress, _fit_class)
+        samplers = [sampler for sampler, _, _ in results]
+        loss = np.mean([class_loss for _, class_loss, _ in results])
+    text_msg = "Training for all classes complete"
+    log_gen_msg(path_to_logger, text_msg)
+    clean_logger(path_to_logger)
+    return samplers, class_names, seq_len, float(loss)
@@ -45,8 +45,12 @@ def impute_data(orig_data,
                 batch_size = 128,
                 hint_rate= 0.9,
                 alpha = 100,
-                iterations = 10000):
+                iterations = 10000,
+                progress = None):
+    # progress: called as progress(iteration=..., iterations=...) while training, see gain.gain_t
     path_to_logger = os.path.join(LOG_PATH, LOG_FILE)
+    # work on a copy: orig_data is the loaded dataset, which may be a read-only memory map
+    orig_data = np.array(orig_data, dtype=np.float32)
     #use original data used to train SenseGen and emulate missing data in it for GAIN training
     for i in range(orig_data.shape[0]):
         q = np.sort(random.sample(range(0, orig_data.shape[1]), 2))
@@ -59,7 +63,7 @@ def impute_data(orig_data,
     imp_clean_logger(path_to_logger)
     msg='Training imputation NN...'
     log_imp_msg(path_to_logger, msg)
-    imputed_data = gain_t(train_data, gain_parameters,t) #trains within seconds and returns several versions of imputed vector
+    imputed_data = gain_t(train_data, gain_parameters,t, progress) #trains within seconds and returns several versions of imputed vector
     msg='Training and Imputation Complete.'
     log_imp_msg(path_to_logger, msg)
     return imputed_data/10
\ No newline at end of file
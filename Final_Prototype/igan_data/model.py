@@ -15,11 +15,15 @@ The above copyright notice and this permission notice shall be included in all c
 THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 """
 
+import collections
+import time
 import numpy as np
 import tensorflow as tf
 tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.FATAL)
 
+import igan_data.data_utils
 import igan_data.model_utils
+import igan_data.numpy_sampler
 
 class ModelConfig(object):
     def __init__(self):
@@ -31,6 +35,8 @@ class ModelConfig(object):
         self.num_steps = 10
         self.dropout_rate = 0.5  # Dropout rate
         self.learning_rate = 0.001  # Learning rate
+        self.num_classes = 0  # Number of classes the MDN model is conditioned on, 0 for none
+        self.class_embedding_size = 8  # Size of the class embedding appended to every input
 
 class RNNModel(object):
     def __init__(self, config, is_training=True):
@@ -131,6 +137,8 @@ class MDNModel(object):
         self.num_mixtures = config.num_mixtures
         self.n_gmm_params = self.num_mixtures * 3
         self.learning_rate = config.learning_rate
+        self.num_classes = config.num_classes
+        self.class_embedding_size = config.class_embedding_size
         with tf.variable_scope('mdn_model', reuse=(not self.is_training)):
             self._build_model()
     
@@ -139,13 +147,27 @@ class MDNModel(object):
         """ Build the MDN Model"""
         self.x_holder = tf.placeholder(tf.float32, [self.batch_size, self.num_steps, 1 ], name="x")
         self.y_holder = tf.placeholder(tf.float32, [self.batch_size, self.num_steps, 1], name="y")
+        # weight of every target in the loss: 0 for padding, 1 otherwise
+        self.mask_holder = tf.placeholder_with_default(tf.ones_like(self.y_holder),
+                                                       [self.batch_size, self.num_steps, 1], name="mask")
+        rnn_inputs = self.x_holder
+        if self.num_classes:
+            # every input sample is followed by the embedding of the class of its sequence
+            self.c_holder = tf.placeholder(tf.int32, [self.batch_size], name="c")
+            class_embedding = tf.get_variable('class_embedding', shape=[self.num_classes, self.class_embedding_size],
+                                              dtype=tf.float32, initializer=tf.truncated_normal_initializer(stddev=0.2))
+            c = tf.nn.embedding_lookup(class_embedding, self.c_holder)
+            c = tf.tile(tf.expand_dims(c, 1), [1, self.num_steps, 1])
+            rnn_inputs = tf.concat([self.x_holder, c], axis=2)
         
         multi_rnn_cell = tf.nn.rnn_cell.MultiRNNCell(
                 [tf.nn.rnn_cell.LSTMCell(self.rnn_size) for _ in range(self.num_layers)], state_is_tuple=True)
-        self.init_state = multi_rnn_cell.zero_state(self.batch_size, tf.float32)
+        # a batch_size of None lets the model run on batches of any size
+        batch_size = self.batch_size if self.batch_size is not None else tf.shape(self.x_holder)[0]
+        self.init_state = multi_rnn_cell.zero_state(batch_size, tf.float32)
         
         rnn_outputs, self.final_state = tf.nn.dynamic_rnn(cell=multi_rnn_cell,
-                                                     inputs=self.x_holder,
+                                                     inputs=rnn_inputs,
                                                      initial_state=self.init_state)
         
         w1 = tf.get_variable('w1', shape=[self.rnn_size, self.hidden_size], dtype=tf.float32,
@@ -176,28 +198,47 @@ class MDNModel(object):
             mixture_p = tf.contrib.distributions.Normal(self.mu, self.sigma).prob(tf.reshape(self.y_holder,(-1,1)))
             mixture_p = tf.multiply(self.pi, mixture_p)
             output_p = tf.reduce_sum(mixture_p, reduction_indices=1, keep_dims=True)
+            # padded targets get probability 1, so they add nothing to the loss or its gradient
+            mask = tf.reshape(self.mask_holder, (-1, 1))
+            output_p = mask * output_p + (1.0 - mask)
             log_output_p = tf.log(output_p)
-            mean_log_output_p = tf.reduce_mean(log_output_p)
+            mean_log_output_p = tf.reduce_sum(log_output_p) / tf.reduce_sum(mask)
             self.loss = -mean_log_output_p   
             self.train_op = self.optimizer.minimize(self.loss)
             
      
     def train_for_epoch(self, sess, data_loader):
+        return self._run_epoch(sess, data_loader, self.train_op)
+
+    def eval_for_epoch(self, sess, data_loader):
+        """ Mean loss over the windows of data_loader, without training. """
+        return self._run_epoch(sess, data_loader, None)
+
+    def _run_epoch(self, sess, data_loader, train_op):
         assert self.is_training, "Must be training model"
-        cur_state = sess.run(self.init_state)
+        zero_state = sess.run(self.init_state)
+        cur_state = zero_state
         data_loader.reset()
         epoch_loss = []
         while data_loader.has_next():
             batch_xs, batch_ys = data_loader.next_batch()
+            # a new batch of sequences starts from an empty recurrent state
+            if data_loader.starts_batch:
+                cur_state = zero_state
             batch_xs = batch_xs.reshape((self.batch_size, self.num_steps, 1))
             batch_ys = batch_ys.reshape((self.batch_size, self.num_steps, 1))
-            _, batch_loss_, new_state_ = sess.run(
-                [self.train_op, self.loss, self.final_state],
-                feed_dict = {
-                    self.x_holder: batch_xs,
-                    self.y_holder: batch_ys,
-                    self.init_state: cur_state,
-                })
+            feed_dict = {
+                self.x_holder: batch_xs,
+                self.y_holder: batch_ys,
+                self.init_state: cur_state,
+            }
+            if data_loader.batch_mask is not None:
+                feed_dict[self.mask_holder] = data_loader.batch_mask
+            if self.num_classes:
+                feed_dict[self.c_holder] = data_loader.batch_classes
+            batch_loss_, new_state_ = sess.run(
+                [self.loss, self.final_state] + ([train_op] if train_op is not None else []),
+                feed_dict = feed_dict)[:2]
             cur_state = new_state_
             epoch_loss.append(batch_loss_)
          
@@ -205,11 +246,14 @@ class MDNModel(object):
         return np.mean(epoch_loss)
     
     
-    def predict(self,sess, seq_len=1000):
+    def predict(self,sess, seq_len=1000, seed=None):
         assert not self.is_training, "Must be testing model"
+        if self.batch_size is None:
+            return list(self.predict_batch(sess, 1, seq_len, seed=seed)[0])
         cur_state = sess.run(self.init_state)
+        mixture_sampler = igan_data.numpy_sampler.MixtureSampler(1, seed)
         preds = []
-        preds.append(np.random.uniform())
+        preds.append(mixture_sampler.first_inputs[0])
         for step in range(seq_len):
             batch_xs = np.array(preds[-1]).reshape((self.batch_size, self.num_steps, 1))
             mu_, sigma_, pi_, new_state_ = sess.run(
@@ -219,17 +263,136 @@ class MDNModel(object):
                     self.init_state: cur_state
                 }
             )
-            # chose one
-            select_mixture = np.random.choice(self.num_mixtures, p=pi_[0])
-            #new_pred_  = np.random.normal(loc=mu_[0
-            new_pred_ = np.random.normal(loc=mu_[0][select_mixture], scale=sigma_[0][select_mixture])
+            new_pred_ = mixture_sampler.draw(mu_, sigma_, pi_)[0]
             preds.append(new_pred_)
             cur_state = new_state_
         return preds[1:]
-            
-            
 
-      
+    def predict_batch(self, sess, num_seq, seq_len=1000, classes=None, seed=None, first_index=0):
+        """ Samples num_seq sequences in lockstep, one sess.run per step for
+        all of them, so the model must have a batch_size of None. A
+        class-conditional model needs the class code of every sequence in
+        classes. The mixtures are sampled as in NumpySampler.sample, so a seed
+        makes the sequences reproducible. Returns a (num_seq, seq_len) array.
+        """
+        assert not self.is_training, "Must be testing model"
+        assert self.batch_size is None, "Batched sampling needs a batch_size of None"
+        mixture_sampler = igan_data.numpy_sampler.MixtureSampler(num_seq, seed, first_index)
+        preds = np.empty((num_seq, seq_len + 1), dtype=np.float32)
+        preds[:, 0] = mixture_sampler.first_inputs
+        feed_dict = {self.x_holder: preds[:, :1, None]}
+        if self.num_classes:
+            feed_dict[self.c_holder] = np.asarray(classes, dtype=np.int32)
+        cur_state = sess.run(self.init_state, feed_dict=feed_dict)
+        for step in range(seq_len):
+            feed_dict[self.x_holder] = preds[:, step:step+1, None]
+            feed_dict[self.init_state] = cur_state
+            mu_, sigma_, pi_, cur_state = sess.run(
+                [self.mu, self.sigma, self.pi, self.final_state],
+                feed_dict = feed_dict
+            )
+            preds[:, step+1] = mixture_sampler.draw(mu_, sigma_, pi_)
+        return preds[:, 1:]
+
+    def predict_classes(self, sess, classes, seq_len=1000, seed=None):
+        """ Samples one sequence for every class code in classes, all of them
+        in one batch (see predict_batch). Returns a (len(classes), seq_len) array.
+        """
+        return self.predict_batch(sess, len(classes), seq_len, classes, seed)
+
+
+# tf.ConfigProto of the sessions of new engines, None for the TF defaults
+SESSION_CONFIG = None
+
+
+class MDNEngine(object):
+    """ A training and a sampling MDNModel sharing their variables in a graph of
+    their own, with one op initialising all of them (Adam slots included).
+    Building the graph is the expensive part, so an engine is built once per
+    configuration and reset for every model trained with it. device - the
+    device the ops of the graph are placed on, e.g. '/CPU:0', None for the
+    TF placement.
+    """
+    def __init__(self, train_config, sample_config, device=None):
+        self.graph = tf.Graph()
+        # a device scope only applies to the graph it is opened in, so it is opened inside this one
+        with self.graph.as_default(), self.graph.device(device):
+            self.train_model = MDNModel(train_config, True)
+            self.sample_model = MDNModel(sample_config, False)
+            self.init_op = tf.global_variables_initializer()
+            self.saver = tf.train.Saver()
+            self._variables = tf.global_variables()
+        self.sess = tf.Session(graph=self.graph, config=SESSION_CONFIG)
+
+    # gives all variables fresh initial values
+    def reset(self):
+        self.sess.run(self.init_op)
+
+    # values of all variables (optimizer slots included) as numpy arrays by variable name
+    def get_weights(self):
+        return dict(zip([v.name for v in self._variables], self.sess.run(self._variables)))
+
+    # loads values returned by get_weights, through the variables' initializers so no ops are added
+    def set_weights(self, weights):
+        for v in self._variables:
+            v.load(weights[v.name], self.sess)
+
+    def close(self):
+        self.sess.close()
+
+
+# number of engines kept alive by get_engine, the least recently used one is closed first
+MAX_ENGINES = 8
+_engines = collections.OrderedDict()
+
+
+def _config_key(config):
+    return tuple(sorted(vars(config).items()))
+
+
+def get_engine(train_config, sample_config, device=None):
+    """ Returns the MDNEngine for these configurations (and device), building it on first use. """
+    key = (_config_key(train_config), _config_key(sample_config), device)
+    if key in _engines:
+        _engines.move_to_end(key)
+    else:
+        _engines[key] = MDNEngine(train_config, sample_config, device)
+        while len(_engines) > MAX_ENGINES:
+            _engines.popitem(last=False)[1].close()
+    return _engines[key]
+
 
+def time_train_epochs(data, config, loader='shuffle', num_epochs=3):
+    """ Seconds per training epoch of MDNModel on data with config, on the
+    CPU. The first epoch (graph building) is not timed. """
+    sample_config = ModelConfig()
+    sample_config.num_layers = config.num_layers
+    sample_config.batch_size = None
+    sample_config.num_steps = 1
+    engine = get_engine(config, sample_config, device='/CPU:0')
+    engine.reset()
+    data_loader = igan_data.data_utils.DATA_LOADERS[loader](data=data, batch_size=config.batch_size, num_steps=config.num_steps)
+    try:
+        engine.train_model.train_for_epoch(engine.sess, data_loader)
+        start = time.time()
+        for _ in range(num_epochs):
+            engine.train_model.train_for_epoch(engine.sess, data_loader)
+    finally:
+        data_loader.close()
+    return (time.time() - start) / num_epochs
 
 
+# python -m igan_data.model <data .npz> <config .json> <loader> <num_epochs>: prints the seconds per epoch of
+# time_train_epochs, run by model_tf2.benchmark with a TF1 interpreter
+if __name__ == '__main__':
+    import json
+    import sys
+    with np.load(sys.argv[1]) as f:
+        if 'offsets' in f.files:
+            data = igan_data.data_utils.RaggedArray(f['values'], f['offsets'])
+        else:
+            data = f['data']
+    config = ModelConfig()
+    with open(sys.argv[2]) as f:
+        vars(config).update(json.load(f))
+    print(time_train_epochs(data, config, sys.argv[3], int(sys.argv[4])))
@@ -0,0 +1,90 @@
+# What: On-disk registry of trained MDN models
+# Why: Generating more samples from data a model was already trained on should not train it again
+
+
+# Usage example:
+#   registry = model_registry.ModelRegistry('server_data/model_registry')
+#   key = registry.key(model_registry.dataset_hash(data), 'N', config)
+#   stored = registry.load(key, num_epochs=150)  # (weights, info) or None
+
+import hashlib
+import json
+import os
+import numpy as np
+
+import igan_data.data_utils
+
+REGISTRY_MAX_BYTES = 512 * 1024**2
+# bump when the stored models change meaning, so old entries are never loaded
+REGISTRY_VERSION = 2
+
+
+def dataset_hash(data):
+    """ Returns a sha256 of the sequences of a matrix or RaggedArray (their lengths and float32 values). """
+    digest = hashlib.sha256()
+    if isinstance(data, igan_data.data_utils.RaggedArray):
+        digest.update(np.ascontiguousarray(data.lengths, dtype=np.int64))
+        values = data.values[data.offsets[0]:data.offsets[-1]]
+    else:
+        digest.update(np.asarray(data.shape, dtype=np.int64))
+        values = data
+    digest.update(np.ascontiguousarray(values, dtype=np.float32))
+    return digest.hexdigest()
+
+
+class ModelRegistry(object):
+    """ Trained model weights on disk, one entry per dataset hash, class label,
+    ModelConfig, seed and any other training options. An entry is a directory
+    holding a snapshot of the model for every number of epochs it was trained
+    for: all of its variables (optimizer slots included) in <epochs>.npz and
+    a small json of information such as the loss history in <epochs>.json.
+    A longer run can so resume from the snapshot of a shorter one. Entries
+    are evicted least recently used first once the registry holds more than
+    max_bytes, as in the dataset cache of data_utils.
+    """
+    def __init__(self, registry_dir, max_bytes=REGISTRY_MAX_BYTES):
+        self.registry_dir = registry_dir
+        self.max_bytes = max_bytes
+
+    def key(self, data_hash, label, config, seed=None, **options):
+        description = json.dumps([REGISTRY_VERSION, data_hash, str(label), sorted(vars(config).items()),
+                                  seed, sorted(options.items())], default=str)
+        return hashlib.sha256(description.encode()).hexdigest()
+
+    def load(self, key, num_epochs):
+        """ Returns the (weights, info) of the snapshot stored under key with
+        the most epochs up to num_epochs, or None if there is none. A
+        snapshot whose info has stopped_early set is the whole run, an exact
+        hit for any num_epochs from its epochs on. """
+        entry_dir = os.path.join(self.registry_dir, key)
+        try:
+            stored_epochs = [int(name[:-len('.npz')]) for name in os.listdir(entry_dir)
+                             if name.endswith('.npz') and name[:-len('.npz')].isdigit()]
+            stored_epochs = [epochs for epochs in stored_epochs if epochs <= num_epochs]
+            if not stored_epochs:
+                return None
+            path = os.path.join(entry_dir, str(max(stored_epochs)))
+            with np.load(path + '.npz') as f:
+                weights = {str(name): f['w%d' % i] for i, name in enumerate(f['names'])}
+            with open(path + '.json') as f:
+                info = json.load(f)
+        except (OSError, ValueError, KeyError):
+            return None
+        os.utime(entry_dir) # mark as recently used
+        return weights, info
+
+    def store(self, key, weights, info):
+        """ Saves weights (a dict of arrays by variable name) and a json-able
+        info dict holding the number of epochs trained (and stopped_early if
+        training stopped before the epochs asked for), each atomically. """
+        entry_dir = os.path.join(self.registry_dir, key)
+        os.makedirs(entry_dir, exist_ok=True)
+        path = os.path.join(entry_dir, str(info['epochs']))
+        names = sorted(weights)
+        with open('%s.npz.tmp%d' % (path, os.getpid()), 'wb') as f:
+            np.savez(f, names=np.array(names), **{'w%d' % i: weights[name] for i, name in enumerate(names)})
+        with open('%s.json.tmp%d' % (path, os.getpid()), 'w') as f:
+            json.dump(info, f)
+        os.replace('%s.npz.tmp%d' % (path, os.getpid()), path + '.npz')
+        os.replace('%s.json.tmp%d' % (path, os.getpid()), path + '.json')
+        igan_data.data_utils._evict_lru(self.registry_dir, self.max_bytes, keep=key)
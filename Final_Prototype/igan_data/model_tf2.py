@@ -0,0 +1,192 @@
+# What: The LSTM-MDN of model.py for TensorFlow 2
+# Where: Same network as igan_data/model.py (after https://github.com/nesl/sensegen)
+# Why: model.py needs tf.placeholder, tf.Session and tf.contrib, which current TensorFlow no longer has
+
+
+# Usage example:
+#   loader = data_utils.ShuffledDataLoader(data, batch_size=128, num_steps=10)
+#   mdn = model_tf2.KerasMDNModel(config)
+#   loss = mdn.train_for_epoch(loader)
+#   fake = mdn.sample(num_seq=10, seq_len=3600, seed=1234)
+#   model_tf2.benchmark(data, tf1_python="/opt/tf1/bin/python")  # seconds per epoch, TF2 here and TF1 in that interpreter
+
+import json
+import os
+import subprocess
+import tempfile
+import time
+import numpy as np
+import tensorflow as tf
+
+import igan_data.data_utils
+import igan_data.model
+import igan_data.numpy_sampler
+
+LOG_2PI = np.log(2.0 * np.pi)
+
+
+def mdn_loss(ys, mask, mu, sigma, log_pi):
+    """ Mean negative log-likelihood of the targets ys under the mixtures, over the targets where mask is 1. """
+    log_p = log_pi - 0.5 * tf.square((ys - mu) / sigma) - tf.math.log(sigma) - 0.5 * LOG_2PI
+    log_p = tf.reduce_logsumexp(log_p, axis=-1, keepdims=True)
+    return -tf.reduce_sum(mask * log_p) / tf.reduce_sum(mask)
+
+
+def loader_dataset(data_loader):
+    """ The windows of one epoch of a data_utils loader as a prefetching
+    tf.data.Dataset of (xs, ys, mask, starts_batch). """
+    shape = [data_loader.batch_size, data_loader.num_steps, 1]
+
+    def windows():
+        data_loader.reset()
+        while data_loader.has_next():
+            batch_xs, batch_ys = data_loader.next_batch()
+            mask = data_loader.batch_mask
+            if mask is None:
+                mask = np.ones(shape, dtype=np.float32)
+            yield (np.asarray(batch_xs, dtype=np.float32).reshape(shape),
+                   np.asarray(batch_ys, dtype=np.float32).reshape(shape),
+                   mask, data_loader.starts_batch)
+
+    window_spec = tf.TensorSpec(shape, tf.float32)
+    return tf.data.Dataset.from_generator(
+        windows, output_signature=(window_spec, window_spec, window_spec, tf.TensorSpec([], tf.bool))
+    ).prefetch(tf.data.AUTOTUNE)
+
+
+class KerasMDNModel(tf.keras.Model):
+    """ The LSTM-MDN of model.MDNModel as a Keras model: stacked LSTMs, a
+    sigmoid hidden layer and the mean, scale and weight of every mixture
+    component. Every training window is one tf.function-compiled step fed
+    from a tf.data pipeline, so there is no feed_dict and no tf.contrib.
+    The recurrent state is carried between the windows of a batch and reset
+    where the loader starts a new one (truncated BPTT, as in train_for_epoch).
+    """
+    def __init__(self, config):
+        super(KerasMDNModel, self).__init__()
+        self.rnn_size = config.rnn_size
+        self.num_layers = config.num_layers
+        self.num_mixtures = config.num_mixtures
+        self.lstms = [tf.keras.layers.LSTM(config.rnn_size, return_sequences=True, return_state=True)
+                      for _ in range(config.num_layers)]
+        initializer = tf.keras.initializers.TruncatedNormal(stddev=0.2)
+        self.hidden = tf.keras.layers.Dense(config.hidden_size, activation='sigmoid', kernel_initializer=initializer)
+        self.gmm = tf.keras.layers.Dense(3 * config.num_mixtures, kernel_initializer=initializer)
+        self.train_optimizer = tf.keras.optimizers.Adam(config.learning_rate)
+
+    def zero_state(self, batch_size):
+        return [tf.zeros([batch_size, self.rnn_size]) for _ in range(2 * self.num_layers)]
+
+    def call(self, inputs, state):
+        """ Returns mu, sigma and log pi of every step and the new state (h and c of every layer). """
+        outputs = inputs
+        new_state = []
+        for i, lstm in enumerate(self.lstms):
+            outputs, h, c = lstm(outputs, initial_state=state[2*i:2*i+2])
+            new_state += [h, c]
+        mu, log_var, logits = tf.split(self.gmm(self.hidden(outputs)), 3, axis=-1)
+        return mu, tf.exp(log_var / 2.0), tf.nn.log_softmax(logits), new_state
+
+    @tf.function
+    def train_step(self, xs, ys, mask, starts, state):
+        # a new batch of sequences starts from an empty recurrent state
+        keep = 1.0 - tf.cast(starts, tf.float32)
+        state = [s * keep for s in state]
+        with tf.GradientTape() as tape:
+            mu, sigma, log_pi, new_state = self(xs, state)
+            loss = mdn_loss(ys, mask, mu, sigma, log_pi)
+        gradients = tape.gradient(loss, self.trainable_variables)
+        self.train_optimizer.apply_gradients(zip(gradients, self.trainable_variables))
+        return loss, new_state
+
+    def _build(self, batch_size, num_steps):
+        # variables and optimizer slots are created eagerly, before the first trace
+        if not self.built:
+            self(tf.zeros([batch_size, num_steps, 1]), self.zero_state(batch_size))
+            # only the optimizers of Keras 3 / TF 2.11 on have build, the older ones create their slots in apply_gradients
+            if hasattr(self.train_optimizer, 'build'):
+                self.train_optimizer.build(self.trainable_variables)
+
+    def train_for_epoch(self, data_loader):
+        self._build(data_loader.batch_size, data_loader.num_steps)
+        state = self.zero_state(data_loader.batch_size)
+        epoch_loss = []
+        for batch_xs, batch_ys, mask, starts in loader_dataset(data_loader):
+            batch_loss, state = self.train_step(batch_xs, batch_ys, mask, starts, state)
+            epoch_loss.append(batch_loss)
+        return float(np.mean(epoch_loss))
+
+    def export_weights(self):
+        """ The weights in the form numpy_sampler.export_weights gives those
+        of model.MDNModel: the kernel of every LSTM with its input and
+        recurrent rows stacked and the gates reordered from Keras' i, f, c, o
+        to LSTMCell's i, j, f, o, the forget bias LSTMCell adds taken out of
+        the bias. """
+        weights = {}
+        for i, lstm in enumerate(self.lstms):
+            kernel, recurrent_kernel, bias = [w.numpy() for w in lstm.cell.weights]
+            order = lambda w: np.concatenate([np.split(w, 4, axis=-1)[gate] for gate in (0, 2, 1, 3)], axis=-1)
+            weights['kernel_%d' % i] = order(np.concatenate((kernel, recurrent_kernel), axis=0))
+            bias = order(bias)
+            bias[2 * self.rnn_size:3 * self.rnn_size] -= igan_data.numpy_sampler.FORGET_BIAS
+            weights['bias_%d' % i] = bias
+        weights['w1'], weights['b1'] = [w.numpy() for w in self.hidden.weights]
+        weights['w2'], weights['b2'] = [w.numpy() for w in self.gmm.weights]
+        return weights
+
+    def sample(self, num_seq=1, seq_len=1000, seed=None, first_index=0):
+        """ Samples num_seq sequences of seq_len with numpy_sampler.NumpySampler,
+        which draws from the per-sequence random streams of MixtureSampler, see
+        NumpySampler.sample. Returns a (num_seq, seq_len) array. """
+        self._build(1, 1)
+        sampler = igan_data.numpy_sampler.NumpySampler(self.export_weights())
+        return sampler.sample(num_seq, seq_len, seed=seed, first_index=first_index)
+
+
+def _time_tf1_epochs(tf1_python, data, config, loader, num_epochs):
+    # runs model.time_train_epochs in a process of tf1_python, the data and config passed through temporary files
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_path, config_path = os.path.join(tmp_dir, 'data.npz'), os.path.join(tmp_dir, 'config.json')
+        if isinstance(data, igan_data.data_utils.RaggedArray):
+            np.savez(data_path, values=data.values, offsets=data.offsets)
+        else:
+            np.savez(data_path, data=np.asarray(data))
+        with open(config_path, 'w') as f:
+            json.dump(vars(config), f)
+        package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        output = subprocess.check_output([tf1_python, '-m', 'igan_data.model', data_path, config_path, loader, str(num_epochs)],
+                                         cwd=package_dir)
+    return float(output.decode().strip().splitlines()[-1])
+
+
+def benchmark(data, num_epochs=3, batch_size=128, loader='shuffle', config=None, tf1_python=None):
+    """ Seconds per training epoch on the CPU of KerasMDNModel and of the
+    TF1 model.MDNModel on data, with the configuration gen_data_GAN uses.
+    The first epoch of each (graph building or tracing) is not timed.
+    KerasMDNModel runs in this process; the TF1 model cannot run next to
+    it, so it is timed in a process of tf1_python, a Python interpreter
+    with TensorFlow 1.x installed. Without tf1_python there is no
+    comparison and the TF1 time is None.
+    """
+    if config is None:
+        config = igan_data.model.ModelConfig()
+        config.learning_rate = 0.003
+        config.num_layers = 1
+    config.batch_size = min(batch_size, len(data))
+    make_loader = igan_data.data_utils.DATA_LOADERS[loader]
+
+    results = {}
+    with tf.device('/CPU:0'):
+        keras_model = KerasMDNModel(config)
+        keras_loader = make_loader(data=data, batch_size=config.batch_size, num_steps=config.num_steps)
+        try:
+            keras_model.train_for_epoch(keras_loader)
+            start = time.time()
+            for _ in range(num_epochs):
+                keras_model.train_for_epoch(keras_loader)
+        finally:
+            keras_loader.close()
+        results['tf2'] = (time.time() - start) / num_epochs
+    results['tf1'] = None if tf1_python is None else _time_tf1_epochs(tf1_python, data, config, loader, num_epochs)
+    print('Seconds per epoch: TF2 %.3f, TF1 %s' % (results['tf2'], 'not run (no tf1_python)' if results['tf1'] is None else '%.3f' % results['tf1']))
+    return results
@@ -0,0 +1,190 @@
+# What: Sampling from a trained LSTM-MDN with numpy only
+# Where: The forward pass of MDNModel in igan_data/model.py (tf.nn.rnn_cell.LSTMCell layers and the mixture output)
+# Why: A sess.run per time step costs more than the step itself for these small models, and sampling should not need TensorFlow
+
+
+# Usage example:
+#   sampler = numpy_sampler.NumpySampler(engine.get_weights())  # or the weights of a ModelRegistry entry
+#   sampler.save('model.npz')
+#   fake = numpy_sampler.NumpySampler.load('model.npz').sample(num_seq=10, seq_len=3600, seed=1234)
+
+import re
+import numpy as np
+
+# forget_bias of tf.nn.rnn_cell.LSTMCell, added to the forget gate and not stored in the weights
+FORGET_BIAS = 1.0
+
+# the variables of MDNModel by their name in the graph, without the variable scope
+_LSTM_VARIABLE = re.compile(r'(?:^|/)multi_rnn_cell/cell_(\d+)/lstm_cell/(kernel|bias):0$')
+_OUTPUT_VARIABLE = re.compile(r'(?:^|/)(w1|b1|w2|b2|class_embedding):0$')
+# steps of random numbers MixtureSampler draws at a time for every sequence
+DRAW_BLOCK_STEPS = 256
+# sequences sampled in lockstep by gen_data_GAN and the LazySampleStore of the server
+SAMPLE_BATCH_SIZE = 512
+
+
+def export_weights(weights):
+    """ Returns the weights sampling needs out of all variables of an MDN
+    model (MDNEngine.get_weights() or a ModelRegistry entry), optimizer
+    slots left out, by short name: kernel_<layer>, bias_<layer>, w1, b1,
+    w2, b2 and class_embedding for class-conditional models.
+    """
+    exported = {}
+    for name, value in weights.items():
+        match = _LSTM_VARIABLE.search(name)
+        if match is not None:
+            exported['%s_%s' % (match.group(2), match.group(1))] = value
+            continue
+        match = _OUTPUT_VARIABLE.search(name)
+        if match is not None:
+            exported[match.group(1)] = value
+    return exported
+
+
+class MixtureSampler(object):
+    """ Draws the next value of a batch of sequences from their mixtures:
+    the mixture of every sequence by inverting its cumulative weights, then
+    a value from that Gaussian. Every sequence has random streams of its
+    own, spawned from the root seed by its index (first_index for the first
+    sequence of the batch), so a sequence gets the same random numbers
+    whichever batch or worker samples it. The numbers are drawn for blocks
+    of DRAW_BLOCK_STEPS steps at once per stream.
+    """
+    def __init__(self, num_seq, seed=None, first_index=0):
+        root = np.random.SeedSequence(seed)
+        # the root entropy, which reproduces the sequences when seed was None
+        self.seed = root.entropy
+        streams = [np.random.SeedSequence(root.entropy, spawn_key=(first_index + i,)).spawn(3) for i in range(num_seq)]
+        # the input of the first step, drawn uniformly as in MDNModel.predict
+        self.first_inputs = np.array([np.random.default_rng(stream[0]).random() for stream in streams], dtype=np.float32)
+        self._mixture_rngs = [np.random.default_rng(stream[1]) for stream in streams]
+        self._noise_rngs = [np.random.default_rng(stream[2]) for stream in streams]
+        self._rows = np.arange(num_seq)
+        self._step = DRAW_BLOCK_STEPS
+
+    def draw(self, mu, sigma, pi):
+        """ mu, sigma, pi - (num_seq, num_mixtures) mixtures, returns one value per sequence. """
+        if self._step == DRAW_BLOCK_STEPS:
+            self._uniforms = np.stack([rng.random(DRAW_BLOCK_STEPS) for rng in self._mixture_rngs], axis=1)
+            self._normals = np.stack([rng.standard_normal(DRAW_BLOCK_STEPS) for rng in self._noise_rngs], axis=1)
+            self._step = 0
+        uniforms, normals = self._uniforms[self._step], self._normals[self._step]
+        self._step += 1
+        select_mixture = (np.cumsum(pi, axis=1) < uniforms[:, None]).sum(axis=1)
+        select_mixture = np.minimum(select_mixture, pi.shape[1] - 1)
+        return mu[self._rows, select_mixture] + sigma[self._rows, select_mixture] * normals
+
+
+def _sigmoid(x):
+    return 0.5 * np.tanh(0.5 * x) + 0.5
+
+
+class NumpySampler(object):
+    """ Samples sequences from the weights of a trained MDNModel, many
+    sequences in lockstep, without TensorFlow. Every step runs the stacked
+    LSTM cells (gates i, j, f, o as in LSTMCell), the sigmoid hidden layer
+    and the mixture parameters for the whole batch with a few matrix
+    products, then draws one mixture and one value per sequence.
+    """
+    def __init__(self, weights):
+        weights = export_weights(weights) if 'w1' not in weights else weights
+        self.num_layers = len([name for name in weights if name.startswith('kernel_')])
+        self.kernels = [np.asarray(weights['kernel_%d' % i], dtype=np.float32) for i in range(self.num_layers)]
+        self.biases = [np.asarray(weights['bias_%d' % i], dtype=np.float32) for i in range(self.num_layers)]
+        self.w1, self.b1 = np.asarray(weights['w1'], dtype=np.float32), np.asarray(weights['b1'], dtype=np.float32)
+        self.w2, self.b2 = np.asarray(weights['w2'], dtype=np.float32), np.asarray(weights['b2'], dtype=np.float32)
+        self.class_embedding = weights.get('class_embedding')
+        if self.class_embedding is not None:
+            self.class_embedding = np.asarray(self.class_embedding, dtype=np.float32)
+        self.rnn_size = self.kernels[0].shape[1] // 4
+        self.num_mixtures = self.w2.shape[1] // 3
+
+    @property
+    def num_classes(self):
+        return 0 if self.class_embedding is None else len(self.class_embedding)
+
+    # the exported weights, as passed to the constructor
+    def weights(self):
+        weights = {'w1': self.w1, 'b1': self.b1, 'w2': self.w2, 'b2': self.b2}
+        for i in range(self.num_layers):
+            weights['kernel_%d' % i], weights['bias_%d' % i] = self.kernels[i], self.biases[i]
+        if self.class_embedding is not None:
+            weights['class_embedding'] = self.class_embedding
+        return weights
+
+    def save(self, path):
+        np.savez(path, **self.weights())
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            return cls({name: f[name] for name in f.files})
+
+    # (c, h) of every layer for num_seq sequences
+    def zero_state(self, num_seq):
+        return [(np.zeros((num_seq, self.rnn_size), dtype=np.float32),
+                 np.zeros((num_seq, self.rnn_size), dtype=np.float32)) for _ in range(self.num_layers)]
+
+    def step(self, xs, state, class_inputs=None):
+        """ Runs one time step for a batch: xs - (n,) inputs, state - as
+        returned by zero_state, class_inputs - (n, embedding size) class
+        embeddings of a conditional model. Returns mu, sigma and pi, each
+        (n, num_mixtures), and the new state.
+        """
+        inputs = xs[:, None]
+        if class_inputs is not None:
+            inputs = np.concatenate((inputs, class_inputs), axis=1)
+        new_state = []
+        for (c, h), kernel, bias in zip(state, self.kernels, self.biases):
+            gates = np.concatenate((inputs, h), axis=1).dot(kernel) + bias
+            i, j, f, o = np.split(gates, 4, axis=1)
+            c = _sigmoid(f + FORGET_BIAS) * c + _sigmoid(i) * np.tanh(j)
+            h = _sigmoid(o) * np.tanh(c)
+            new_state.append((c, h))
+            inputs = h
+        gmm_params = _sigmoid(inputs.dot(self.w1) + self.b1).dot(self.w2) + self.b2
+        mu = gmm_params[:, :self.num_mixtures]
+        sigma = np.exp(gmm_params[:, self.num_mixtures:2 * self.num_mixtures] / 2.0)
+        logits = gmm_params[:, 2 * self.num_mixtures:]
+        pi = np.exp(logits - logits.max(axis=1, keepdims=True))
+        pi /= pi.sum(axis=1, keepdims=True)
+        return mu, sigma, pi, new_state
+
+    def sample(self, num_seq, seq_len=1000, classes=None, seed=None, first_index=0):
+        """ Samples num_seq sequences of seq_len, as MDNModel.predict_batch
+        does; a class-conditional model needs the class code of every
+        sequence in classes. With a seed the sequences are reproducible, see
+        MixtureSampler: sampling sequences first_index and on in blocks gives
+        the same values whichever process samples a block, and whatever the
+        size of the blocks. Returns a (num_seq, seq_len) array.
+        """
+        if num_seq == 0:
+            return np.empty((0, seq_len), dtype=np.float32)
+        # the batch row of every sequence: a single sequence runs as two identical rows, as the matrix
+        # products of a one-row batch take another BLAS path and give slightly different values
+        rows = np.arange(num_seq) if num_seq != 1 else np.zeros(2, dtype=np.int64)
+        class_inputs = None
+        if self.class_embedding is not None:
+            class_inputs = self.class_embedding[np.asarray(classes, dtype=np.int64).reshape(-1)[rows]]
+        mixture_sampler = MixtureSampler(num_seq, seed, first_index)
+        preds = np.empty((len(rows), seq_len + 1), dtype=np.float32)
+        preds[:, 0] = mixture_sampler.first_inputs[rows]
+        state = self.zero_state(len(rows))
+        for step in range(seq_len):
+            mu, sigma, pi, state = self.step(preds[:, step], state, class_inputs)
+            preds[:, step+1] = mixture_sampler.draw(mu[:num_seq], sigma[:num_seq], pi[:num_seq])[rows]
+        return preds[:num_seq, 1:]
+
+
+def check_batch_sizes(sampler, num_seq=5, seq_len=50, classes=None, seed=1234):
+    """ Checks that sampling sequences 0..num_seq-1 one at a time, in pairs
+    and in a single batch gives the same bytes, returns True if it does. """
+    whole = sampler.sample(num_seq, seq_len, classes, seed)
+    for batch_size in (1, 2):
+        for start in range(0, num_seq, batch_size):
+            batch_classes = None if classes is None else classes[start:start+batch_size]
+            batch = sampler.sample(min(batch_size, num_seq - start), seq_len, batch_classes, seed, first_index=start)
+            if batch.tobytes() != whole[start:start+batch_size].tobytes():
+                return False
+    return True
+
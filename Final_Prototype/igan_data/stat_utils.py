@@ -3,6 +3,10 @@ from skbio.diversity import beta_diversity
 from skbio.stats import distance
 import scipy
 from scipy import stats
+from scipy.spatial.distance import cdist
+
+# rows of new samples whose distances to all samples are computed at once
+DIVERSITY_BLOCK_ROWS = 256
 
 
 def data_dist(data):
@@ -60,6 +64,58 @@ def data_novelty(data, order=40, number=4):
 # _ =  plt.hist(flattened_f, color='blue', bins=20,label='Novelty')
 # use glob_nov as the overall score (it's just a single number)
 
+
+class DatasetMetrics(object):
+    """ Novelty and diversity of a dataset, kept per sample so that samples can
+    be appended without scoring the whole dataset again. The novelty features
+    of a sample only depend on the sample itself, and its diversity score is
+    the mean of its Bray-Curtis distances to all samples, so appending k
+    samples to n only computes the k new features and the k x (n + k) new
+    distances. The novelty features depend on the width of the matrix too
+    (shorter samples of a ragged store are zero-padded to it), so they are
+    all computed again when an append changes that width; the Bray-Curtis
+    distances do not change with zero padding. The scores equal those of
+    data_novelty and data_diversity.
+    """
+
+    def __init__(self, data=None):
+        self.novelty_features = None
+        # width of the matrix the novelty features were computed at
+        self.width = None
+        # sum of the Bray-Curtis distances of every sample to all samples
+        self.distance_sums = np.zeros(0)
+        if data is not None:
+            self.append(data)
+
+    def __len__(self):
+        return len(self.distance_sums)
+
+    # data - all samples as an (n, len) matrix, the ones from start on being new
+    def append(self, data, start=0):
+        if start == 0 or data.shape[1] != self.width:
+            self.novelty_features = data_novelty(data)[0]
+        else:
+            self.novelty_features = np.concatenate((self.novelty_features, data_novelty(data[start:])[0]))
+        self.width = data.shape[1]
+        data = np.absolute(data)
+        sums = np.zeros(data.shape[0])
+        sums[:start] = self.distance_sums[:start]
+        for i in range(start, data.shape[0], DIVERSITY_BLOCK_ROWS):
+            distances = cdist(data[i:i + DIVERSITY_BLOCK_ROWS], data, 'braycurtis')
+            sums[:start] += distances[:, :start].sum(axis=0)
+            sums[i:i + len(distances)] = distances.sum(axis=1)
+        self.distance_sums = sums
+
+    # same results as data_novelty
+    def novelty(self):
+        avg_f_per_sig = np.mean(self.novelty_features, axis=1)
+        return self.novelty_features, self.novelty_features.flatten(), avg_f_per_sig, np.mean(avg_f_per_sig)
+
+    # same results as data_diversity
+    def diversity(self):
+        t = self.distance_sums / len(self)
+        return t, np.mean(t)
+
 def feat_RMSE(orig_data, fake_data):
     minf = []
     maxf = []
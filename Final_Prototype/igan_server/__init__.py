@@ -1 +1,3 @@
 from .request_handlers import *
+from .sample_store import *
+from .jobs import *
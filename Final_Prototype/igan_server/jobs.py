@@ -0,0 +1,137 @@
+import numbers
+import threading
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+# number of finished jobs whose status is kept for the status endpoints
+MAX_FINISHED_JOBS = 100
+
+
+# raised inside the function of a job by its progress callback once the job is cancelled
+class JobCancelled(Exception):
+    pass
+
+
+# one function run in the background by a JobQueue
+class Job(object):
+    def __init__(self, kind):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        # 'queued', 'running', 'done', 'failed' or 'cancelled'
+        self.status = 'queued'
+        # keyword arguments of the last progress report, e.g. epoch and num_epochs
+        self.progress = {}
+        # updates for main_window returned by the function, only scalars are kept once they are merged
+        self.result = None
+        self.error = None
+        self._cancel = threading.Event()
+        self._lock = threading.Lock()
+        self._published = []
+
+    # progress callback handed to the function of the job, updates - partial results for main_window, if any
+    def report(self, updates=None, **progress):
+        if updates is not None:
+            with self._lock:
+                self._published.append(updates)
+        self.progress = dict(self.progress, **progress)
+        if self._cancel.is_set():
+            raise JobCancelled()
+
+    # returns the partial results reported since the last call
+    def pop_published(self):
+        with self._lock:
+            published, self._published = self._published, []
+        return published
+
+    def cancel(self):
+        self._cancel.set()
+
+    @property
+    def finished(self):
+        return self.status in ('done', 'failed', 'cancelled')
+
+    # the numbers and strings among the updates returned by the function, e.g. the loss
+    def scalar_result(self):
+        if self.result is None:
+            return {}
+        return {key: value.item() if isinstance(value, np.generic) else value
+                for key, value in self.result.items() if isinstance(value, (numbers.Number, str))}
+
+    # status of the job as sent to the browser
+    def info(self):
+        return {'id': self.id, 'kind': self.kind, 'status': self.status,
+                'progress': self.progress, 'error': self.error}
+
+
+class JobQueue(object):
+    """ Runs long requests (training, imputation) in background threads so the
+    request that submits them returns at once. A job function gets a progress
+    keyword argument to report its progress (and partial results) with, which
+    raises JobCancelled once the job is cancelled, and returns the updates
+    main_window applies to the data. These are collected by pop_updates. One
+    worker by default: jobs share the models and graphs of igan_data.
+    """
+    def __init__(self, num_workers=1):
+        self._executor = ThreadPoolExecutor(num_workers)
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._unmerged = []
+
+    # returns the id of the job running fn(*args, progress=..., **kwargs)
+    def submit(self, kind, fn, *args, **kwargs):
+        job = Job(kind)
+        with self._lock:
+            self._jobs[job.id] = job
+        self._executor.submit(self._run, job, fn, args, kwargs)
+        return job.id
+
+    def _run(self, job, fn, args, kwargs):
+        try:
+            job.report()
+            job.status = 'running'
+            job.result = fn(*args, progress=job.report, **kwargs)
+            job.status = 'done'
+            with self._lock:
+                self._unmerged.append(job)
+        except JobCancelled:
+            job.status = 'cancelled'
+        except Exception as e:
+            traceback.print_exc()
+            job.error = str(e)
+            job.status = 'failed'
+        self._forget_old_jobs()
+
+    def _forget_old_jobs(self):
+        with self._lock:
+            finished = [job_id for job_id, job in self._jobs.items() if job.finished and job not in self._unmerged]
+            for job_id in finished[:-MAX_FINISHED_JOBS]:
+                del self._jobs[job_id]
+
+    # returns the job with this id, or None
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    # asks the job to stop, it is cancelled at its next progress report
+    def cancel(self, job_id):
+        job = self.get(job_id)
+        if job is not None and not job.finished:
+            job.cancel()
+        return job
+
+    # returns the partial results and the results of the jobs reported or finished since the last call,
+    # in order; the results of a job come after its partial results
+    def pop_updates(self):
+        with self._lock:
+            jobs = list(self._jobs.values())
+            finished, self._unmerged = self._unmerged, []
+        updates = []
+        for job in jobs:
+            updates.extend(job.pop_published())
+            if job in finished:
+                updates.append(job.result)
+                # the samples of the result now belong to the data store
+                job.result = job.scalar_result()
+        return updates
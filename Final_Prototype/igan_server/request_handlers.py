@@ -2,12 +2,22 @@ import scipy.io
 import numpy as np
 import igan_data
 import os
+from .sample_store import SampleStore, LazySampleStore
 
 UPLOADS_DIR = 'server_data'
 FILE_NAME = "my_data_zipped.zip"
+# decoded uploads are cached here, so uploading the same archive again is instant
+CACHE_DIR = os.path.join(UPLOADS_DIR, 'dataset_cache')
+# trained models are kept here, so generating again from the same data skips training
+MODEL_REGISTRY = igan_data.ModelRegistry(os.path.join(UPLOADS_DIR, 'model_registry'))
 
 # some constants we will need
 ALLOWED_EXTENSIONS = ['mat', 'csv', 'zip']
+# training of a model stops once its loss has not improved by more than this for this many epochs
+EARLY_STOPPING_PATIENCE = 10
+EARLY_STOPPING_MIN_DELTA = 1e-3
+# number of epochs trained for with a time limit and no number of epochs given
+MAX_EPOCHS = 10000
 
 
 # dummy function to emulate data generation
@@ -94,9 +104,11 @@ class SwitchHandler(FormHandler):
 # class to handle data imputation
 class ImputeDataFormHandler(FormHandler):
     # button_name - name of the button used for form submission
-    def __init__(self, button_name):
+    # jobs - igan_server.JobQueue to impute in the background, if any
+    def __init__(self, button_name, jobs=None):
         # save the name of the form this handler is connected to
         self.button_name = button_name
+        self.jobs = jobs
 
     # generate data using GAN
     def handle(self, request, data_pack):
@@ -105,7 +117,9 @@ class ImputeDataFormHandler(FormHandler):
             # if necessary data is loaded into the pack
             if 'data_dict' in data_pack:
                 # prepare input data
-                inp_data = np.copy(data_pack['data_dict']['gen_y'][data_pack['data_dict']["current_gen"]])
+                gen = data_pack['data_dict']['gen']
+                current_gen = data_pack['data_dict']["current_gen"]
+                inp_data = np.copy(gen.sample(current_gen))
                 # check if start index or end index are out-of-bounds
                 start_indx = int(data_pack['data_dict']["start"])
                 end_indx = int(data_pack['data_dict']["end"])
@@ -123,18 +137,28 @@ class ImputeDataFormHandler(FormHandler):
 
                 iterations = int(request.form['iterations'])
                 batch = int(request.form['batch'])
-                imputed_data = igan_data.impute_data(orig_data=data_pack['data_dict']['orig_y'],
-                                                       data_type='.mat',
-                                                       inp_data=inp_data,
-                                                       miss_rate=0.3,
-                                                       batch_size=128,
-                                                       hint_rate=0.9,
-                                                       alpha=100,
-                                                       iterations=10000)
-
-                imputed_data = imputed_data[:, 0]
-                updates = {"updated_sample": imputed_data}
-                return updates
+                orig_data = data_pack['data_dict']['orig'].matrix()
+
+                def impute(progress=None):
+                    imputed_data = igan_data.impute_data(orig_data=orig_data,
+                                                           data_type='.mat',
+                                                           inp_data=inp_data,
+                                                           miss_rate=0.3,
+                                                           batch_size=128,
+                                                           hint_rate=0.9,
+                                                           alpha=100,
+                                                           iterations=10000,
+                                                           progress=progress)
+
+                    imputed_data = imputed_data[:, 0]
+                    # the sample is only replaced if it is still the one shown when the job finishes
+                    return {"updated_sample": imputed_data,
+                            "sample_store": gen,
+                            "sample_index": current_gen}
+
+                if self.jobs is not None:
+                    return {"job": self.jobs.submit('impute', impute)}
+                return impute()
             else:
                 return {}
         else:
@@ -144,9 +168,11 @@ class ImputeDataFormHandler(FormHandler):
 # class to handle data generation
 class GenerateDataFormHandler(FormHandler):
     # button_name - name of the button used for form submission
-    def __init__(self, button_name):
+    # jobs - igan_server.JobQueue to generate in the background, if any
+    def __init__(self, button_name, jobs=None):
         # save the name of the form this handler is connected to
         self.button_name = button_name
+        self.jobs = jobs
 
     # generate data using GAN
     def handle(self, request, data_pack):
@@ -154,6 +180,7 @@ class GenerateDataFormHandler(FormHandler):
         if self.button_name in request.form:
             # if necessary data is loaded into the pack
             if 'data_dict' in data_pack:
+                orig = data_pack['data_dict']['orig']
                 # read string with number of samples
                 num_seq = request.form['samples']
                 # filter out brackets []
@@ -163,31 +190,102 @@ class GenerateDataFormHandler(FormHandler):
                 # if the last element has length 0, delete it
                 if len(num_seq[-1]) == 0: num_seq.pop()
                 # if length is not equal to the number of classes, cut the array
-                if len(num_seq) > len(set(data_pack['data_dict']['orig_class'])):
-                    num_seq = num_seq[:len(set(data_pack['data_dict']['orig_class']))]
+                if len(num_seq) > orig.num_classes:
+                    num_seq = num_seq[:orig.num_classes]
                 # convert all entries to int
                 for i in range(len(num_seq)):
                     num_seq[i] = int(num_seq[i])
-                # read the number of epochs
-                num_epochs = int(request.form['epochs'])
-                syn_data, syn_class, _, loss = igan_data.gen_data.gen_data_multiclass(data_pack['data_dict']['orig_y'],
-                                                                                      data_pack['data_dict']['orig_class'],
-                                                                                      len(set(data_pack['data_dict']['orig_class'])),
-                                                                                      num_seq,
-                                                                                      data_type='.mat',
-                                                                                      model_chkpoint=min(2, num_epochs),
-                                                                                      num_epochs=num_epochs)
-
-                # create timestamps accordingly
-                timestamps = np.zeros_like(syn_data)
-                for i in range(syn_data.shape[0]):
-                    timestamps[i, :] = np.arange(syn_data.shape[1])
-                updates = {"gen_data_vals": syn_data,
-                           "gen_data_classes": syn_class,
-                           "gen_data_timestamps": timestamps,
-                           "change_to_gen": 0,
-                           "loss": loss}
-                return updates
+                # read the time limit in seconds, if any
+                time_budget = request.form.get('time_budget', '').strip()
+                time_budget = float(time_budget) if time_budget else None
+                # read the number of epochs, it may be left out when there is a time limit
+                epochs = request.form['epochs'].strip()
+                num_epochs = int(epochs) if epochs or time_budget is None else MAX_EPOCHS
+                sequences, classes, num_classes = orig.sequences(), orig.classes(), orig.num_classes
+                conditional = 'conditional' in request.form
+                lazy = 'lazy' in request.form
+
+                def generate(progress=None):
+                    syn_data, syn_class, _, loss = igan_data.gen_data.gen_data_multiclass(sequences,
+                                                                                          classes,
+                                                                                          num_classes,
+                                                                                          num_seq,
+                                                                                          data_type='.mat',
+                                                                                          model_chkpoint=min(2, num_epochs),
+                                                                                          num_epochs=num_epochs,
+                                                                                          loader='shuffle',
+                                                                                          conditional=conditional,
+                                                                                          patience=EARLY_STOPPING_PATIENCE,
+                                                                                          min_delta=EARLY_STOPPING_MIN_DELTA,
+                                                                                          time_budget=time_budget,
+                                                                                          registry=MODEL_REGISTRY,
+                                                                                          progress=progress)
+
+                    updates = {"gen_store": SampleStore.from_classes(syn_data, syn_class),
+                               "change_to_gen": 0,
+                               "loss": loss}
+                    return updates
+
+                # in the background the samples are handed to main_window as they are generated
+                def generate_stream(progress):
+                    stream = igan_data.gen_data.iter_gen_data_multiclass(sequences,
+                                                                         classes,
+                                                                         num_classes,
+                                                                         num_seq,
+                                                                         data_type='.mat',
+                                                                         model_chkpoint=min(2, num_epochs),
+                                                                         num_epochs=num_epochs,
+                                                                         loader='shuffle',
+                                                                         conditional=conditional,
+                                                                         patience=EARLY_STOPPING_PATIENCE,
+                                                                         min_delta=EARLY_STOPPING_MIN_DELTA,
+                                                                         time_budget=time_budget,
+                                                                         registry=MODEL_REGISTRY,
+                                                                         progress=progress)
+                    losses = {}
+                    for i, (label, sample, loss) in enumerate(stream):
+                        losses[label] = loss
+                        store = SampleStore.from_classes(sample[None, :], [label])
+                        if i == 0:
+                            # the first sample replaces the samples generated before
+                            updates = {"gen_stream": store, "change_to_gen": 0}
+                        else:
+                            updates = {"gen_append": store}
+                        progress(updates=updates, generated=i+1, **{"class": str(label)})
+                    updates = {"gen_metrics": 0}
+                    if losses:
+                        updates["loss"] = float(np.mean(list(losses.values())))
+                    return updates
+
+                # in lazy mode only the models are trained, the samples are generated when they are looked at
+                def generate_lazy(progress=None):
+                    samplers, class_names, seq_len, loss = igan_data.gen_data.fit_gen_data_multiclass(sequences,
+                                                                                                     classes,
+                                                                                                     num_classes,
+                                                                                                     data_type='.mat',
+                                                                                                     model_chkpoint=min(2, num_epochs),
+                                                                                                     num_epochs=num_epochs,
+                                                                                                     loader='shuffle',
+                                                                                                     conditional=conditional,
+                                                                                                     patience=EARLY_STOPPING_PATIENCE,
+                                                                                                     min_delta=EARLY_STOPPING_MIN_DELTA,
+                                                                                                     time_budget=time_budget,
+                                                                                                     registry=MODEL_REGISTRY,
+                                                                                                     progress=progress)
+                    updates = {"gen_lazy": LazySampleStore(samplers, class_names, num_seq, seq_len),
+                               "change_to_gen": 0,
+                               "loss": loss}
+                    return updates
+
+                if lazy:
+                    generate_fn = generate_lazy
+                elif self.jobs is not None:
+                    generate_fn = generate_stream
+                else:
+                    generate_fn = generate
+                if self.jobs is not None:
+                    return {"job": self.jobs.submit('generate', generate_fn)}
+                return generate_fn()
             else:
                 return {}
         else:
@@ -197,11 +295,13 @@ class GenerateDataFormHandler(FormHandler):
 # class to handle data loading
 class LoadDataFormHandler(FormHandler):
     # button_name - name of the button used for form submission
-    def __init__(self, button_name, input_field_name):
+    # append_field_name - name of the checkbox asking to append the file to the loaded data
+    def __init__(self, button_name, input_field_name, append_field_name=None):
         # save the name of the form this handler is connected to
         self.button_name = button_name
         # save the name of the form this handler is connected to
         self.input_field_name = input_field_name
+        self.append_field_name = append_field_name
 
     # this function loads data in the system and updates the chart
     def handle(self, request, data_pack):
@@ -218,28 +318,26 @@ class LoadDataFormHandler(FormHandler):
                     return {}
                 # if file extension is allowed
                 elif file and allowed_file(file.filename):
+                    # new samples either replace the loaded ones or are appended to them
+                    store_key = "orig_append" if self.append_field_name in request.form else "orig_store"
                     # if this file has *.mat extension
                     if file.filename.rsplit('.', 1)[1].lower() == "mat":
                         original_data = scipy.io.loadmat(file.stream)
-                        updates = {"orig_data_vals": (ecg_mat_to_np_converter(original_data))[0],
-                                   "orig_data_timestamps": (ecg_mat_to_np_converter(original_data))[1],
+                        values, _ = ecg_mat_to_np_converter(original_data)
+                        updates = {store_key: SampleStore(values[np.newaxis, :], [0], ['0']),
                                    "change_to_orig": True}
                         return updates
                     # if this file has *.zip extension
                     elif file.filename.rsplit('.', 1)[1].lower() == "zip":
                         # save data file to open it later
                         file.save(os.path.join(UPLOADS_DIR, FILE_NAME))
-                        # read data from data file
-                        values, data_classes, num_classes = igan_data.load_training_data(os.path.join(UPLOADS_DIR, FILE_NAME), '.mat')
+                        # read data from data file, decoding large archives on all cores
+                        values, class_codes, class_labels, _ = igan_data.load_dataset(os.path.join(UPLOADS_DIR, FILE_NAME), '.mat',
+                                                                                      num_workers=None,
+                                                                                      cache_dir=CACHE_DIR)
                         # delete data
                         os.remove(os.path.join(UPLOADS_DIR, FILE_NAME))
-                        # create timestamps accordingly
-                        timestamps = np.zeros_like(values)
-                        for i in range(values.shape[0]):
-                            timestamps[i, :] = np.arange(values.shape[1])
-                        updates = {"orig_data_vals": values,
-                                   "orig_data_classes": data_classes,
-                                   "orig_data_timestamps": timestamps,
+                        updates = {store_key: SampleStore(values, class_codes, class_labels),
                                    "change_to_orig": 0}
                         return updates
                     else:
@@ -0,0 +1,235 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import igan_data
+
+# samples a LazySampleStore generates ahead of the last one looked at
+PREFETCH_AHEAD = 3
+# generates the samples ahead of the cursor of every LazySampleStore, one sample at a time
+_prefetcher = ThreadPoolExecutor(1)
+
+
+# returns buffer, or a copy of it with room for at least size entries if it is too small (or read-only)
+def _reserve(buffer, size):
+    if len(buffer) >= size and buffer.flags.writeable:
+        return buffer
+    grown = np.empty(max(size, 2 * len(buffer)), dtype=buffer.dtype)
+    grown[:len(buffer)] = buffer
+    return grown
+
+
+# samples of a dataset as they are kept by the server
+class SampleStore(object):
+    """ Values, classes and timestamps of the samples shown in the UI.
+    Values are float32 and stored back to back in one flat buffer with the
+    offset of every sample, so samples may have different lengths. Classes
+    are int32 codes into a small table of labels. Timestamps are not stored:
+    the timestamps of a sample are the first len(sample) entries of one
+    shared arange. Getting a sample, its timestamps or its class is O(1) and
+    returns views, never copies. The buffers grow geometrically, so appending
+    samples costs amortised O(new samples).
+    """
+    __slots__ = ('labels', '_values', '_offsets', '_codes', '_size', '_timestamps')
+
+    # values - (n, len) matrix or igan_data.RaggedArray, codes - class of every sample as an index into labels
+    def __init__(self, values, codes, labels):
+        if isinstance(values, igan_data.RaggedArray):
+            flat, offsets = values.values, values.offsets - values.offsets[0]
+        else:
+            values = np.asarray(values)
+            flat = values.reshape(-1)
+            offsets = np.arange(values.shape[0] + 1, dtype=np.int64) * values.shape[1]
+        self._values = flat.astype(np.float32, copy=False)
+        self._offsets = np.asarray(offsets, dtype=np.int64)
+        self._codes = np.asarray(codes, dtype=np.int32)
+        self.labels = np.asarray(labels)
+        self._size = len(self._codes)
+        self._timestamps = np.arange(self.lengths.max() if len(self) else 0)
+
+    # creates a store from the class name of every sample
+    @classmethod
+    def from_classes(cls, values, classes):
+        labels, codes = np.unique(classes, return_inverse=True)
+        return cls(values, codes, labels)
+
+    def __len__(self):
+        return self._size
+
+    # all samples are in memory, unlike in a LazySampleStore
+    @property
+    def materialised(self):
+        return True
+
+    @property
+    def codes(self):
+        return self._codes[:self._size]
+
+    @property
+    def lengths(self):
+        return np.diff(self._offsets[:self._size + 1])
+
+    @property
+    def num_classes(self):
+        return len(self.labels)
+
+    @property
+    def nbytes(self):
+        return self._values.nbytes + self._offsets.nbytes + self._codes.nbytes + self._timestamps.nbytes
+
+    def sample(self, i):
+        return self._values[self._offsets[i]:self._offsets[i + 1]]
+
+    def timestamps(self, i):
+        return self._timestamps[:self._offsets[i + 1] - self._offsets[i]]
+
+    def label(self, i):
+        return self.labels[self._codes[i]]
+
+    # class name of every sample
+    def classes(self):
+        return self.labels[self.codes]
+
+    def set_sample(self, i, values):
+        self.sample(i)[:] = values
+
+    # all samples as an (n, len) matrix view, or as a RaggedArray view if their lengths differ
+    def sequences(self):
+        offsets = self._offsets[:self._size + 1]
+        ragged = igan_data.RaggedArray(self._values[:offsets[-1]], offsets)
+        return ragged.to_matrix() if ragged.is_uniform() else ragged
+
+    # all samples as an (n, len) matrix, shorter ones padded with zeros (a copy only in that case)
+    def matrix(self):
+        sequences = self.sequences()
+        if isinstance(sequences, igan_data.RaggedArray):
+            return sequences.padded()
+        return sequences
+
+    # appends samples given as for the constructor, returns the range of their indices
+    def append(self, values, codes, labels):
+        new = SampleStore(values, codes, labels)
+        # translate the class codes of the new samples to this store's label table
+        label_codes = {label: code for code, label in enumerate(self.labels)}
+        added_labels = [label for label in new.labels if label not in label_codes]
+        if added_labels:
+            self.labels = np.concatenate((self.labels, added_labels))
+            label_codes = {label: code for code, label in enumerate(self.labels)}
+        new_codes = np.array([label_codes[label] for label in new.labels], dtype=np.int32)[new.codes]
+        start, stop = self._size, self._size + len(new)
+        value_start, value_stop = self._offsets[start], self._offsets[start] + new._offsets[len(new)]
+        self._values = _reserve(self._values, value_stop)
+        self._offsets = _reserve(self._offsets, stop + 1)
+        self._codes = _reserve(self._codes, stop)
+        self._values[value_start:value_stop] = new._values[:new._offsets[len(new)]]
+        self._offsets[start + 1:stop + 1] = new._offsets[1:len(new) + 1] + value_start
+        self._codes[start:stop] = new_codes
+        self._size = stop
+        if len(self._timestamps) < new.lengths.max():
+            self._timestamps = np.arange(new.lengths.max())
+        return start, stop
+
+
+# generated samples of a dataset, each one sampled only once it is looked at
+class LazySampleStore(object):
+    """ The samples a set of trained models would generate, as a SampleStore
+    that samples them on demand. The classes of all samples are known up
+    front, but a sample is only generated (then kept) when it is first
+    asked for, and the next PREFETCH_AHEAD are generated in the background
+    while it is looked at. Every sample has random streams of its own (see
+    igan_data.numpy_sampler.MixtureSampler) and NumpySampler.sample gives
+    the same values whatever the size of the batch a sample is generated in
+    (see igan_data.numpy_sampler.check_batch_sizes), so a sample does not
+    depend on the order the samples are generated in. matrix() and
+    sequences() generate all samples that are still missing.
+    """
+    # samplers - igan_data.NumpySampler of every class, num_seq - number of samples of every class
+    def __init__(self, samplers, labels, num_seq, seq_len, seed=None):
+        self.samplers = samplers
+        self.labels = np.asarray(labels)
+        self._codes = np.repeat(np.arange(len(labels), dtype=np.int32), num_seq[:len(labels)])
+        # the seed entropy, so that the samples are the same whoever generates them
+        self.seed = np.random.SeedSequence(seed).entropy
+        self._values = np.empty((len(self._codes), seq_len), dtype=np.float32)
+        self._ready = np.zeros(len(self._codes), dtype=bool)
+        self._timestamps = np.arange(seq_len)
+        self._lock = threading.Lock()
+        self._prefetching = False
+
+    def __len__(self):
+        return len(self._codes)
+
+    @property
+    def materialised(self):
+        return bool(self._ready.all())
+
+    @property
+    def codes(self):
+        return self._codes
+
+    @property
+    def lengths(self):
+        return np.full(len(self), self._values.shape[1], dtype=np.int64)
+
+    @property
+    def num_classes(self):
+        return len(self.labels)
+
+    @property
+    def nbytes(self):
+        return self._values.nbytes + self._codes.nbytes + self._ready.nbytes + self._timestamps.nbytes
+
+    # generates the samples among indices (ascending) that are not generated yet,
+    # runs of consecutive samples from the same sampler in one batch
+    def _generate(self, indices):
+        with self._lock:
+            indices = [i for i in indices if not self._ready[i]]
+            while indices:
+                start = stop = indices[0]
+                sampler = self.samplers[self._codes[start]]
+                while (stop - start < igan_data.numpy_sampler.SAMPLE_BATCH_SIZE and stop - start < len(indices)
+                       and indices[stop - start] == stop and self.samplers[self._codes[stop]] is sampler):
+                    stop += 1
+                classes = self._codes[start:stop] if sampler.num_classes else None
+                self._values[start:stop] = sampler.sample(stop - start, self._values.shape[1], classes,
+                                                          seed=self.seed, first_index=start)
+                self._ready[start:stop] = True
+                indices = indices[stop - start:]
+
+    def _prefetch(self, i):
+        try:
+            for j in range(i + 1, i + 1 + PREFETCH_AHEAD):
+                self._generate([j % len(self)])
+        finally:
+            self._prefetching = False
+
+    def sample(self, i):
+        self._generate([i])
+        if not self._prefetching and not self._ready[[(i + j) % len(self) for j in range(1, PREFETCH_AHEAD + 1)]].all():
+            self._prefetching = True
+            _prefetcher.submit(self._prefetch, i)
+        return self._values[i]
+
+    def timestamps(self, i):
+        return self._timestamps
+
+    def label(self, i):
+        return self.labels[self._codes[i]]
+
+    # class name of every sample
+    def classes(self):
+        return self.labels[self._codes]
+
+    def set_sample(self, i, values):
+        self.sample(i)[:] = values
+
+    # generates all samples that are still missing
+    def materialise(self):
+        self._generate(list(np.flatnonzero(~self._ready)))
+
+    # all samples as an (n, len) matrix view, generating the missing ones
+    def sequences(self):
+        self.materialise()
+        return self._values
+
+    def matrix(self):
+        return self.sequences()